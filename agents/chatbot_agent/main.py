@@ -1,19 +1,77 @@
 #!/usr/bin/env python3
 # <project-root>/agents/chatbot_agent/main.py
+import hashlib
 import os
+import sys
+import threading
+import time
 import yaml
-from groq import Groq
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 from datetime import datetime
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.ehr_models import EHRRecord
+from common.ehr_snapshot import EHRSnapshot, corpus_fingerprint, load_or_build
+from common.ehr_summary import load_summary
+from common.llm_gateway import Priority, get_gateway
+from common.record_cache import RecordCache
+from common.sharded_store import EHR_OUTPUT_METADATA, ShardedStore
+from common.vector_index import VectorIndex, record_text
+
+from model_router import ModelRouter, is_cross_patient
+from response_cache import ResponseCache
+from structured_query import StructuredQueryEngine
+
+COHORT_MAP_PROMPT = """You review one batch of patient summaries for a question about the whole patient population.
+List only the facts from this batch that help answer the question, each with the patient ID.
+Be brief. If nothing in this batch is relevant, reply with exactly: NONE"""
+
 class MedicalChatbot:
     def __init__(self):
-        self.client = Groq(api_key=os.getenv("API_KEY"))
+        self.gateway = get_gateway()
         self.llm_model = os.getenv("LLM_MODEL", "llama-3.1-8b-instant")
+        self.router = ModelRouter(self.llm_model)
         self.ehr_dir = Path(os.getenv("EHR_OUTPUT_DIR", "../ehr_agent/ehr_outputs"))
+        # File names come from the store's journal; refreshes only read what was written since
+        self.ehr_store = ShardedStore(self.ehr_dir, exclude=EHR_OUTPUT_METADATA)
+        # Parsed records beyond this budget spill to disk, least recently used first
+        self.record_cache_bytes = int(float(os.getenv("CHAT_RECORD_CACHE_MB", "64")) * 1024 * 1024)
+        # Processes share one compiled, memory-mapped copy of the corpus instead of each parsing it
+        self.use_snapshot = os.getenv("CHAT_SNAPSHOT", "true").lower() == "true"
+        self.snapshot_path = Path(os.getenv("CHAT_SNAPSHOT_PATH", str(self.ehr_dir / ".snapshot" / "corpus.snap")))
         
         # Load all EHR data
         self.patient_data = self.load_all_ehr_data()
+        # Snapshot replaced by the last refresh, unmapped on the next one once requests using it are done
+        self.retired_snapshot = None
+        self.structured_queries = StructuredQueryEngine(self.patient_data)
+        
+        # Offline semantic retrieval; only new or changed records are re-embedded
+        # Worker processes share one index directory; only the one holding its writer lock embeds records
+        self.vector_index = VectorIndex.open_shared(
+            os.getenv("CHAT_VECTOR_INDEX_DIR", "vector_index"),
+            dim=int(os.getenv("VECTOR_INDEX_DIM", "256")),
+        )
+        self.retrieval_top_k = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "3"))
+        self.retrieval_min_score = float(os.getenv("CHAT_RETRIEVAL_MIN_SCORE", "0.1"))
+        # Cross-patient questions get one-line summaries, plus full records for only the best matches
+        self.full_records_top_k = int(os.getenv("CHAT_FULL_RECORDS_TOP_K", "2"))
+        # Cohorts too large for one prompt are split into batches answered concurrently, then reduced
+        self.cohort_batch_tokens = int(os.getenv("CHAT_COHORT_BATCH_TOKENS", "3000"))
+        self.cohort_deadline_s = float(os.getenv("CHAT_COHORT_DEADLINE_S", "30"))
+        self.cohort_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("CHAT_COHORT_CONCURRENCY", "4")), thread_name_prefix="cohort"
+        )
+        self.index_patient_data()
+        
+        # Answers are reused while the patient records behind them are unchanged
+        similarity = os.getenv("CHAT_CACHE_SIMILARITY")
+        self.response_cache = ResponseCache(
+            max_entries=int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "512")),
+            ttl_seconds=float(os.getenv("CHAT_CACHE_TTL_S", "600")),
+            similarity_threshold=float(similarity) if similarity else None,
+        )
         
         # REALLY REALLY good system prompt
         self.system_prompt = """You are Dr. VitalMesh, an exceptional AI medical assistant with access to comprehensive Electronic Health Records. You are:
@@ -60,38 +118,98 @@ When responding:
 You are not just answering questions - you are providing expert medical consultation based on comprehensive patient records. Be thorough, insightful, and genuinely helpful."""
 
     def load_all_ehr_data(self):
-        """Load all EHR files into memory"""
-        patient_data = {}
-        
+        """Load all EHR files: mapped from the compiled snapshot, or parsed into the record cache"""
         if not self.ehr_dir.exists():
             print(f"⚠️  EHR directory not found: {self.ehr_dir}")
-            return patient_data
+            return RecordCache(self.record_cache_bytes, spill_dir=os.getenv("RECORD_CACHE_DIR"), name="patient_data")
             
-        ehr_files = list(self.ehr_dir.glob("*_comprehensive_ehr.yaml"))
+        ehr_files = [self.ehr_store.resolve(name) for name in self.ehr_store.names()
+                     if name.endswith("_comprehensive_ehr.yaml")]
+        if self.use_snapshot:
+            snapshot = load_or_build(self.snapshot_path, corpus_fingerprint(ehr_files), lambda: self.parse_ehr_files(ehr_files))
+            print(f"✅ Mapped EHR snapshot with {len(snapshot)} patients")
+            return snapshot
+        
+        patient_data = RecordCache(self.record_cache_bytes, spill_dir=os.getenv("RECORD_CACHE_DIR"), name="patient_data")
+        for patient_id, info in self.parse_ehr_files(ehr_files):
+            patient_data[patient_id] = info
+        
+        print(f"✅ Loaded EHR data for {len(patient_data)} patients")
+        return patient_data
+
+    def parse_ehr_files(self, ehr_files):
+        """Parse EHR files into (patient_id, info) pairs in patient id order"""
         print(f"📋 Loading {len(ehr_files)} EHR files...")
+        patient_id_of = lambda path: path.stem.replace('_comprehensive_ehr', '')
         
-        for ehr_file in ehr_files:
+        for ehr_file in sorted(ehr_files, key=lambda path: patient_id_of(path).encode('utf-8')):
             try:
-                with open(ehr_file, 'r') as f:
-                    patient_id = ehr_file.stem.replace('_comprehensive_ehr', '')
-                    patient_data[patient_id] = {
-                        'data': yaml.safe_load(f),
-                        'file_path': str(ehr_file),
-                        'last_updated': datetime.fromtimestamp(ehr_file.stat().st_mtime)
-                    }
+                raw = ehr_file.read_bytes()
+                patient_id = patient_id_of(ehr_file)
+                data = yaml.safe_load(raw)
+                info = {
+                    'data': EHRRecord.from_dict(data),
+                    'summary': load_summary(ehr_file, data),
+                    'file_path': str(ehr_file),
+                    'last_updated': datetime.fromtimestamp(ehr_file.stat().st_mtime),
+                    'version': hashlib.sha1(raw).hexdigest()
+                }
             except Exception as e:
                 print(f"❌ Error loading {ehr_file}: {e}")
-        
-        print(f"✅ Loaded EHR data for {len(patient_data)} patients")
-        return patient_data
+                continue
+            yield patient_id, info
 
     def refresh_data(self):
         """Refresh EHR data from files"""
         print("🔄 Refreshing patient data...")
+        previous = self.patient_data
         self.patient_data = self.load_all_ehr_data()
+        if isinstance(previous, RecordCache):
+            previous.close()
+        elif isinstance(previous, EHRSnapshot) and previous is not self.patient_data:
+            if self.retired_snapshot is not None:
+                self.retired_snapshot.close()
+            self.retired_snapshot = previous
+        self.structured_queries = StructuredQueryEngine(self.patient_data)
+        self.index_patient_data()
+        stale = self.response_cache.invalidate({pid: info['version'] for pid, info in self.patient_data.items()})
+        if stale:
+            print(f"🧹 Dropped {stale} cached answers for changed patient records")
+
+    def index_patient_data(self):
+        """Bring the vector index in line with the loaded EHR files"""
+        if not self.vector_index.promote():
+            # Another worker writes the index from the same corpus; pick up its rows
+            self.vector_index.reload()
+            return
+        # A snapshot already indexed by this or an earlier writer does not need every record decoded again
+        indexed_path = self.vector_index.index_dir / "snapshot.fingerprint"
+        fingerprint = self.patient_data.fingerprint.hex() if isinstance(self.patient_data, EHRSnapshot) else None
+        if fingerprint and indexed_path.exists() and indexed_path.read_text() == fingerprint:
+            return
+        for patient_id in set(self.vector_index.rows) - set(self.patient_data):
+            self.vector_index.remove(patient_id)
+        changed = self.vector_index.upsert_many(
+            (patient_id, record_text(info['data']), info['version'])
+            for patient_id, info in self.patient_data.items()
+        )
+        if changed:
+            print(f"🧭 Indexed {changed} new/updated patient records")
+        if fingerprint:
+            indexed_path.write_text(fingerprint)
+
+    def search_index(self, query, k):
+        """Vector search; read-only workers first pick up rows the writer added"""
+        if not self.vector_index.writable:
+            self.vector_index.reload()
+        return self.vector_index.search(query, k=k, min_score=self.retrieval_min_score)
 
     def get_context_for_query(self, query):
         """Get relevant patient context based on the query"""
+        return self.build_context(self.get_relevant_patients(query))
+
+    def get_relevant_patients(self, query):
+        """Pick the patient ids whose records should go into the prompt"""
         query_lower = query.lower()
         relevant_patients = []
         
@@ -101,18 +219,135 @@ You are not just answering questions - you are providing expert medical consulta
                 relevant_patients = [patient_id]
                 break
         
-        # If no specific patient mentioned, find relevant ones based on keywords
+        # If no specific patient mentioned, find semantically similar records ("shortness of breath" ~ "dyspnea")
         if not relevant_patients:
-            for patient_id, patient_info in self.patient_data.items():
-                patient_str = yaml.dump(patient_info['data'], default_flow_style=False).lower()
-                if any(word in patient_str for word in query_lower.split() if len(word) > 3):
-                    relevant_patients.append(patient_id)
+            relevant_patients = [
+                patient_id
+                for patient_id, _ in self.search_index(query, self.retrieval_top_k)
+                if patient_id in self.patient_data
+            ]
         
         # If still no matches, include all patients for general queries
         if not relevant_patients:
             relevant_patients = list(self.patient_data.keys())[:3]  # Limit to 3 for context size
         
-        # Build context string
+        return relevant_patients
+
+    def get_cohort_patients(self, query):
+        """Patients summarized in a cross-patient prompt (everyone), and the few that also get their full record"""
+        cohort = list(self.patient_data.keys())
+        detailed = [
+            pid
+            for pid, _ in self.search_index(query, self.full_records_top_k)
+            if pid in self.patient_data
+        ]
+        return cohort, detailed
+
+    def partition_cohort(self, cohort):
+        """Split the cohort into batches whose summaries fit the per-call token budget"""
+        batches, current, used = [], [], 0
+        for patient_id in cohort:
+            tokens = len(self.patient_data[patient_id]['summary']) // 4 + 8
+            if current and used + tokens > self.cohort_batch_tokens:
+                batches.append(current)
+                current, used = [], 0
+            current.append(patient_id)
+            used += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def answer_cohort(self, user_input, batches, detailed, versions):
+        """Map the question over patient batches concurrently, then reduce the findings in one call"""
+        started = time.monotonic()
+        map_model, map_max_tokens = self.router.tiers["small"]
+        deadline = started + self.cohort_deadline_s
+        # Set at the deadline so running batches give their executor worker back to the next query
+        expired = threading.Event()
+        
+        def extract(batch):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or expired.is_set():
+                return None
+            context = self.build_summary_context(batch, [])
+            return self.gateway.chat(
+                model=map_model,
+                messages=[
+                    {"role": "system", "content": COHORT_MAP_PROMPT},
+                    {"role": "user", "content": f"{context}\n\nQUESTION: {user_input}"}
+                ],
+                temperature=0.1,
+                max_tokens=map_max_tokens,
+                priority=Priority.INTERACTIVE,
+                timeout=remaining,
+                cancelled=expired
+            )
+        
+        print(f"🧮 Cohort mode: {sum(len(b) for b in batches)} patients in {len(batches)} batches")
+        futures = {self.cohort_executor.submit(extract, batch): batch for batch in batches}
+        done, not_done = wait(futures, timeout=self.cohort_deadline_s)
+        expired.set()
+        for future in not_done:
+            future.cancel()
+        
+        findings, covered = [], 0
+        for future in futures:
+            if future not in done:
+                continue
+            if future.exception() is not None:
+                print(f"⚠️  Cohort batch failed: {future.exception()}")
+                continue
+            if future.result() is None:
+                continue
+            covered += len(futures[future])
+            result = future.result().strip()
+            if result and result.upper() != "NONE":
+                findings.append(result)
+        total = sum(len(b) for b in batches)
+        if not covered:
+            return "❌ Error: could not review any patient batch in time.\n\nPlease try again or check your API connection."
+        
+        context = f"\n=== COHORT FINDINGS ({covered} of {total} patients reviewed) ===\n"
+        context += "\n".join(f"- {finding}" for finding in findings) or "- No relevant findings in any batch"
+        if detailed:
+            context += "\n" + self.build_context(detailed)
+        full_prompt = f"{context}\n\n🗣️ QUERY: {user_input}\n\nCombine these findings into one answer covering the whole patient population."
+        
+        decision = self.router.route(user_input, total)
+        decision.reasons.append(f"cohort map-reduce ({len(batches)} batches)")
+        try:
+            response = self.gateway.chat(
+                model=decision.model,
+                messages=[
+                    {"role": "system", "content": self.system_prompt},
+                    {"role": "user", "content": full_prompt}
+                ],
+                temperature=0.3,
+                max_tokens=decision.max_tokens,
+                priority=Priority.INTERACTIVE
+            )
+        except Exception as e:
+            self.router.record(decision, user_input, time.monotonic() - started, error=str(e))
+            return f"❌ Error: {e}\n\nPlease try again or check your API connection."
+        
+        self.router.record(decision, user_input, time.monotonic() - started, prompt_tokens=len(full_prompt) // 4)
+        if covered < total:
+            # Partial answers are not cached so the next ask can cover everyone
+            return f"{response}\n\n⚠️ Based on {covered} of {total} patients reviewed within the time budget."
+        self.response_cache.put(user_input, versions, response)
+        return response
+
+    def build_summary_context(self, cohort, detailed):
+        """Build the prompt context from patient summaries plus a few full records"""
+        context = "\n=== PATIENT SUMMARIES ===\n"
+        for patient_id in cohort:
+            context += f"- {patient_id.upper()}: {self.patient_data[patient_id]['summary']}\n"
+        if detailed:
+            context += self.build_context(detailed)
+        return context
+
+    def build_context(self, relevant_patients):
+        """Build the prompt context string for the given patients"""
         context = "\n=== PATIENT EHR DATABASE ===\n"
         for patient_id in relevant_patients:
             if patient_id in self.patient_data:
@@ -132,25 +367,61 @@ You are not just answering questions - you are providing expert medical consulta
             self.refresh_data()
             return f"🔄 Data refreshed! Now tracking {len(self.patient_data)} patients."
         
+        # Another process recompiled the shared snapshot: switch to the new corpus
+        if isinstance(self.patient_data, EHRSnapshot) and self.patient_data.is_stale():
+            self.refresh_data()
+        
+        # Counts, filtered lists and single-field lookups are answered from the records directly
+        answer = self.structured_queries.answer(user_input)
+        if answer is not None:
+            return answer
+        
+        # Serve a cached answer if the same question was asked over the same records
+        cross_patient = is_cross_patient(user_input)
+        if cross_patient:
+            relevant_patients, detailed_patients = self.get_cohort_patients(user_input)
+        else:
+            relevant_patients = self.get_relevant_patients(user_input)
+        versions = {pid: self.patient_data[pid]['version'] for pid in relevant_patients if pid in self.patient_data}
+        cached = self.response_cache.get(user_input, versions)
+        if cached is not None:
+            return cached
+        
+        # Population questions that do not fit one prompt go through cohort map-reduce
+        if cross_patient:
+            batches = self.partition_cohort(relevant_patients)
+            if len(batches) > 1:
+                return self.answer_cohort(user_input, batches, detailed_patients, versions)
+        
         # Get relevant context
-        context = self.get_context_for_query(user_input)
+        if cross_patient:
+            context = self.build_summary_context(relevant_patients, detailed_patients)
+        else:
+            context = self.build_context(relevant_patients)
         
         # Create the prompt
         full_prompt = f"{context}\n\n🗣️ QUERY: {user_input}\n\nPlease provide a detailed medical response based on the available patient data."
         
+        # Pick the cheapest model tier that can handle the query
+        decision = self.router.route(user_input, len(versions))
+        started = time.monotonic()
         try:
-            response = self.client.chat.completions.create(
-                model=self.llm_model,
+            response = self.gateway.chat(
+                model=decision.model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
                     {"role": "user", "content": full_prompt}
                 ],
                 temperature=0.3,
-                max_tokens=2000
+                max_tokens=decision.max_tokens,
+                priority=Priority.INTERACTIVE
             )
-            return response.choices[0].message.content
+            self.router.record(decision, user_input, time.monotonic() - started, prompt_tokens=len(full_prompt) // 4)
+            self.response_cache.put(user_input, versions, response)
+            return response
         
         except Exception as e:
+            self.router.record(decision, user_input, time.monotonic() - started, error=str(e))
             return f"❌ Error: {e}\n\nPlease try again or check your API connection."
 
     def run_interactive(self):
@@ -182,6 +453,10 @@ You are not just answering questions - you are providing expert medical consulta
             except EOFError:
                 print("\n\n👋 Goodbye!")
                 break
+        
+        for tier, stats in self.router.summary().items():
+            print(f"📈 {tier} ({stats['model']}): {stats['calls']} calls, {stats['errors']} errors, mean {stats['mean_ms']}ms")
+        self.patient_data.report()
 
 if __name__ == "__main__":
     from dotenv import load_dotenv
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# <project-root>/agents/chatbot_agent/model_router.py
+"""
+Model cascade for MedicalChatbot.chat.
+
+Each query is scored on its length, how many patient records go into the
+prompt and whether it asks for analysis, then sent to one of three tiers:
+
+  small     single-patient lookups; fast model with a tight token cap
+  standard  everything else; the configured LLM_MODEL
+  large     differential diagnosis or cross-patient analysis only
+
+Every decision is appended to a JSON-lines log together with the call
+latency, so the thresholds can be tuned against mean latency and cost.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Reasoning requests that deserve at least the standard model
+ANALYTICAL_PATTERN = re.compile(
+    r"\b(why|explain|interpret|assess|evaluate|suggest|recommend|plan|treatment|manage|risk|prognosis|"
+    r"worse|worsening|improv\w*|trend\w*|cause[sd]?|likely)\b"
+)
+# The only reasons to escalate to the large model
+DIFFERENTIAL_PATTERN = re.compile(r"\b(differential|ddx|rule out|possible diagnos\w*|what could (?:this|it) be)\b")
+CROSS_PATIENT_PATTERN = re.compile(
+    r"\b(compare|comparison|across|all patients|between patients|which patients|any patients|cohort|population|"
+    r"pattern\w*|common(?:ly)?|most patients)\b"
+)
+
+
+def is_cross_patient(query: str) -> bool:
+    """Whether the question is about the patient population rather than one record"""
+    return bool(CROSS_PATIENT_PATTERN.search(query.lower()))
+
+
+@dataclass
+class RouteDecision:
+    tier: str
+    model: str
+    max_tokens: int
+    score: int
+    reasons: List[str] = field(default_factory=list)
+
+
+class ModelRouter:
+    def __init__(self, default_model: str):
+        self.tiers = {
+            "small": (os.getenv("LLM_MODEL_SMALL", "llama-3.1-8b-instant"),
+                      int(os.getenv("CHAT_SMALL_MAX_TOKENS", "400"))),
+            "standard": (default_model, int(os.getenv("CHAT_MAX_TOKENS", "2000"))),
+            "large": (os.getenv("LLM_MODEL_LARGE", "llama-3.3-70b-versatile"),
+                      int(os.getenv("CHAT_LARGE_MAX_TOKENS", "2000"))),
+        }
+        self.small_max_score = int(os.getenv("CHAT_ROUTER_SMALL_MAX_SCORE", "1"))
+        self.log_path = Path(os.getenv("CHAT_ROUTING_LOG", "logs/chat_routing.jsonl"))
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = defaultdict(lambda: {"calls": 0, "errors": 0, "total_s": 0.0})
+
+    def route(self, query: str, patient_count: int) -> RouteDecision:
+        text = query.lower()
+        score, reasons = 0, []
+
+        words = len(text.split())
+        if words > 60:
+            score, reasons = score + 2, reasons + [f"long query ({words} words)"]
+        elif words > 25:
+            score, reasons = score + 1, reasons + [f"medium query ({words} words)"]
+
+        if patient_count > 3:
+            score, reasons = score + 2, reasons + [f"{patient_count} patients in context"]
+        elif patient_count > 1:
+            score, reasons = score + 1, reasons + [f"{patient_count} patients in context"]
+
+        if ANALYTICAL_PATTERN.search(text):
+            score, reasons = score + 2, reasons + ["analytical wording"]
+
+        differential = DIFFERENTIAL_PATTERN.search(text)
+        cross_patient = is_cross_patient(text) and patient_count > 1
+        if differential:
+            reasons.append("differential diagnosis")
+        if cross_patient:
+            reasons.append("cross-patient analysis")
+
+        if differential or cross_patient:
+            tier = "large"
+        elif score <= self.small_max_score:
+            tier = "small"
+        else:
+            tier = "standard"
+
+        model, max_tokens = self.tiers[tier]
+        return RouteDecision(tier=tier, model=model, max_tokens=max_tokens, score=score, reasons=reasons)
+
+    def record(self, decision: RouteDecision, query: str, latency_s: float, error: Optional[str] = None,
+               prompt_tokens: Optional[int] = None):
+        """Log one routed call and fold it into the per-tier stats"""
+        entry = {
+            "timestamp": time.time(),
+            **asdict(decision),
+            "query_words": len(query.split()),
+            "prompt_tokens": prompt_tokens,
+            "latency_ms": round(latency_s * 1000, 1),
+            "error": error,
+        }
+        with self._lock:
+            stats = self.stats[decision.tier]
+            stats["calls"] += 1
+            stats["total_s"] += latency_s
+            if error:
+                stats["errors"] += 1
+            try:
+                self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                print(f"⚠️  Could not write routing log: {e}")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Calls, errors and mean latency (ms) per tier"""
+        with self._lock:
+            return {
+                tier: {
+                    "model": self.tiers[tier][0],
+                    "calls": int(stats["calls"]),
+                    "errors": int(stats["errors"]),
+                    "mean_ms": round(stats["total_s"] / stats["calls"] * 1000, 1) if stats["calls"] else 0.0,
+                }
+                for tier, stats in self.stats.items()
+            }
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# <project-root>/agents/chatbot_agent/response_cache.py
+"""
+Response cache for MedicalChatbot.chat.
+
+Entries are keyed by the normalized query plus a fingerprint of the patient
+records (id and content version) that went into the prompt, so a cached
+answer can only be served while those records are unchanged. Two lookup tiers:
+
+  exact       identical normalized query over the same records
+  similarity  optional; character-trigram cosine similarity above a threshold,
+              still restricted to entries built from the same records and
+              asking about the same numbers and comparison operators
+
+Entries expire after a TTL and the least recently used are evicted once the
+cache is full.
+"""
+
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+
+# Numbers and comparison operators change the answer even when the wording is close
+QUALIFIER_PATTERN = re.compile(r"\d+(?:\.\d+)?|[<>=!]+|[≤≥≠]")
+
+
+def normalize_query(query: str) -> str:
+    """Fold case and whitespace only; punctuation and operators stay significant"""
+    return " ".join(query.lower().split())
+
+
+def records_fingerprint(versions: Iterable[Tuple[str, str]]) -> str:
+    """Stable hash over (patient_id, version) pairs"""
+    digest = hashlib.sha1()
+    for patient_id, version in sorted(versions):
+        digest.update(f"{patient_id}:{version};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _trigram_vector(text: str) -> Tuple[Counter, float]:
+    padded = f"  {text} "
+    vector = Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+    return vector, math.sqrt(sum(v * v for v in vector.values()))
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 600, similarity_threshold: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._entries: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, query: str, versions: Dict[str, str]) -> Optional[str]:
+        normalized = normalize_query(query)
+        fingerprint = records_fingerprint(versions.items())
+        now = time.monotonic()
+
+        with self._lock:
+            key = (normalized, fingerprint)
+            entry = self._entries.get(key)
+            if entry and now - entry["created"] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.stats["exact_hits"] += 1
+                return entry["response"]
+            if entry:
+                del self._entries[key]
+
+            if self.similarity_threshold:
+                vector, norm = _trigram_vector(normalized)
+                qualifiers = QUALIFIER_PATTERN.findall(normalized)
+                best_key, best_score = None, self.similarity_threshold
+                for candidate_key, candidate in self._entries.items():
+                    if candidate_key[1] != fingerprint or now - candidate["created"] > self.ttl_seconds:
+                        continue
+                    if candidate["qualifiers"] != qualifiers:
+                        continue
+                    score = _cosine(vector, norm, candidate["vector"], candidate["norm"])
+                    if score >= best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.stats["similar_hits"] += 1
+                    return self._entries[best_key]["response"]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, query: str, versions: Dict[str, str], response: str):
+        normalized = normalize_query(query)
+        key = (normalized, records_fingerprint(versions.items()))
+        vector, norm = _trigram_vector(normalized)
+        with self._lock:
+            self._entries[key] = {
+                "response": response,
+                "created": time.monotonic(),
+                "patients": dict(versions),
+                "vector": vector,
+                "norm": norm,
+                "qualifiers": QUALIFIER_PATTERN.findall(normalized),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, current_versions: Dict[str, str]) -> int:
+        """Drop entries built from patient records that changed or disappeared"""
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if any(current_versions.get(pid) != version for pid, version in entry["patients"].items())
+            ]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _cosine(a: Counter, a_norm: float, b: Counter, b_norm: float) -> float:
+    if not a_norm or not b_norm:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(count * b.get(gram, 0) for gram, count in a.items()) / (a_norm * b_norm)
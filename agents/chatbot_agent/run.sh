@@ -16,7 +16,7 @@ echo "✅ Using VitalMesh conda environment"
 
 # Install required packages in conda environment
 echo "📥 Installing dependencies in conda environment..."
-pip install -q groq python-dotenv pyyaml
+pip install -q groq python-dotenv pyyaml numpy
 
 # Load environment variables from .env file if it exists
 if [ -f ".env" ]; then
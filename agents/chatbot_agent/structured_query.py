@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# <project-root>/agents/chatbot_agent/structured_query.py
+"""
+Deterministic answers for structured chatbot questions.
+
+Recognizes a few question shapes over the loaded EHR data and answers them
+straight from indexed fields, without an LLM call:
+
+  count   "how many patients are high urgency", "how many patients have chest pain"
+  list    "list patients with chest pain", "which patients are critical"
+  lookup  "show P003's vitals", "what is P001's chief complaint", "what are the symptoms of P002"
+
+Filters on urgency level and symptom / complaint terms can be combined with
+"and". Every other word has to be a known filler word or occur in some
+patient's complaint or symptoms; otherwise, and for "or" and negations, the
+question returns None so the caller falls through to the LLM rather than
+getting a confident answer to a different question. A lookup must consist of
+nothing but the question opener, one patient and one field.
+"""
+
+import re
+import threading
+from collections import defaultdict
+from collections.abc import Mapping
+from typing import Dict, List, Optional, Set
+
+URGENCY_LEVELS = ["low", "medium", "high", "critical"]
+
+# Field keywords a lookup can ask for, mapped to EHR sections
+LOOKUP_FIELDS = {
+    "vitals": "vitals",
+    "vital signs": "vitals",
+    "symptoms": "symptoms",
+    "chief complaint": "chief_complaint",
+    "complaint": "chief_complaint",
+    "urgency": "urgency_level",
+    "diagnosis": "assessment",
+    "assessment": "assessment",
+    "recommendations": "recommendations",
+    "medical history": "medical_history",
+    "history": "medical_history",
+    "info": "patient_info",
+    "details": "patient_info",
+    "age": "patient_info",
+    "gender": "patient_info",
+}
+
+# Questions asking for reasoning need the LLM even if they mention a field
+ANALYTICAL_WORDS = re.compile(
+    r"\b(why|explain|should|compare|suggest|think|interpret|mean|risk|worse|worsening|improv|trend|recommend\w* for)\b"
+)
+
+COUNT_PATTERN = re.compile(r"^(?:how many|count(?: the)?|number of)\s+patients?\b(?P<rest>.*)$")
+LIST_PATTERN = re.compile(r"^(?:list|show(?: me)?|which|who are|find|get)(?: all)?(?: the)?\s+patients?\b(?P<rest>.*)$")
+FILLER_WORDS = {
+    "are", "is", "with", "have", "has", "having", "who", "that", "a", "an", "the", "of", "level",
+    "urgency", "priority", "patients", "patient", "presenting", "reporting", "complaining", "about", "do", "does",
+}
+LOOKUP_PATTERN = re.compile(r"^(?:what(?:'s| is| are| was| were)|show(?: me)?|get|give me|tell me)\s+(?P<rest>.+)$")
+# Words a lookup may contain besides the patient and the field
+LOOKUP_FILLER_WORDS = {"the", "patient", "patient's", "of", "for", "recorded", "current"}
+# Conditions the filters cannot express
+UNSUPPORTED_WORDS = {"or", "not", "no", "without", "except", "excluding", "but", "nor", "never", "neither"}
+# Count phrasings that ask for all patients: "how many patients are there (in total)"
+COUNT_ALL_PATTERN = re.compile(r"^(?:(?:are|is) there|do (?:we|you) have)?\s*(?:(?:in )?total)?$")
+
+
+class StructuredQueryEngine:
+    def __init__(self, patient_data: Dict[str, Dict]):
+        self.patient_data = patient_data
+        self.by_urgency: Dict[str, Set[str]] = defaultdict(set)
+        self.clinical_text: Dict[str, str] = {}
+        self.identifiers: Dict[str, str] = {}
+        # Words a symptom / complaint filter may use
+        self.vocabulary: Set[str] = set()
+        # Built on the first question that needs it: indexing decodes every record
+        self._indexed = False
+        self._index_lock = threading.Lock()
+
+    def _ensure_index(self):
+        if self._indexed:
+            return
+        with self._index_lock:
+            if not self._indexed:
+                self._build_index()
+                self._indexed = True
+
+    def _build_index(self):
+        for key, info in self.patient_data.items():
+            ehr = info.get("data") or {}
+            urgency = (ehr.get("urgency_level") or "").strip().lower()
+            if urgency:
+                self.by_urgency[urgency].add(key)
+
+            terms = [ehr.get("chief_complaint") or ""]
+            terms += [(s or {}).get("symptom") or "" for s in ehr.get("symptoms") or []]
+            self.clinical_text[key] = " | ".join(t for t in terms if t).lower()
+            self.vocabulary.update(re.findall(r"[a-z0-9']+", self.clinical_text[key]))
+
+            patient_info = ehr.get("patient_info") or {}
+            self.identifiers[key.lower()] = key
+            for identifier in (patient_info.get("patient_id"), patient_info.get("name")):
+                if identifier:
+                    self.identifiers.setdefault(str(identifier).lower(), key)
+
+    def answer(self, query: str) -> Optional[str]:
+        """Answer the query from indexed fields, or None if it needs the LLM"""
+        text = " ".join(re.sub(r"[?!.,]", " ", query.lower()).split())
+        if not text or ANALYTICAL_WORDS.search(text):
+            return None
+
+        match = COUNT_PATTERN.match(text)
+        if match:
+            rest = match["rest"].strip()
+            if COUNT_ALL_PATTERN.match(rest):
+                return f"📊 {len(self.patient_data)} patient(s) in total."
+            self._ensure_index()
+            matches = self._filter(rest)
+            return None if matches is None else f"📊 {len(matches)} patient(s) match: {self._describe(rest)}."
+
+        match = LIST_PATTERN.match(text)
+        if match:
+            self._ensure_index()
+            matches = self._filter(match["rest"])
+            if matches is None:
+                return None
+            if not matches:
+                return f"📋 No patients match: {self._describe(match['rest'])}."
+            lines = [f"📋 {len(matches)} patient(s) match: {self._describe(match['rest'])}"]
+            for key in sorted(matches):
+                ehr = self.patient_data[key].get("data") or {}
+                name = (ehr.get("patient_info") or {}).get("name") or "unknown"
+                lines.append(f"- {key}: {name} | {ehr.get('chief_complaint') or 'no complaint recorded'} | urgency: {ehr.get('urgency_level') or 'n/a'}")
+            return "\n".join(lines)
+
+        return self._lookup(text)
+
+    def _filter(self, rest: str) -> Optional[List[str]]:
+        """Apply urgency and symptom / complaint filters, or None if the condition is not understood"""
+        matches = set(self.patient_data)
+        words = rest.split()
+        if any(w in UNSUPPORTED_WORDS or w.endswith("n't") for w in words):
+            return None
+        terms = self._terms(words)
+        if any(w not in self.vocabulary for term in terms for w in term.split()):
+            return None
+
+        levels = {w for w in words if w in URGENCY_LEVELS}
+        if "urgent" in words:
+            levels |= {"high", "critical"}
+        if levels:
+            matches &= set().union(*(self.by_urgency.get(level, set()) for level in levels))
+
+        for term in terms:
+            matches = {key for key in matches if term in self.clinical_text.get(key, "")}
+        return sorted(matches)
+
+    def _terms(self, words: List[str]) -> List[str]:
+        """Symptom / complaint phrases in the condition, split on 'and'"""
+        terms, current = [], []
+        for word in words + ["and"]:
+            if word == "and":
+                if current:
+                    terms.append(" ".join(current))
+                current = []
+            elif word not in FILLER_WORDS and word not in URGENCY_LEVELS and word != "urgent":
+                current.append(word)
+        return terms
+
+    def _describe(self, rest: str) -> str:
+        words = rest.split()
+        parts = [f"{level} urgency" for level in URGENCY_LEVELS if level in words]
+        if "urgent" in words:
+            parts.append("high or critical urgency")
+        parts += self._terms(words)
+        return " and ".join(parts) or "all patients"
+
+    def _lookup(self, text: str) -> Optional[str]:
+        # Only direct questions for one field of one patient: "what is P003's <field>", "show <field> for P003"
+        match = LOOKUP_PATTERN.match(text)
+        if match is None:
+            return None
+        rest = match["rest"]
+        field_word = next((word for word in sorted(LOOKUP_FIELDS, key=len, reverse=True) if re.search(rf"\b{word}\b", rest)), None)
+        if field_word is None:
+            return None
+        rest = re.sub(rf"\b{field_word}\b", " ", rest, count=1)
+
+        self._ensure_index()
+        key = None
+        for ident in sorted(self.identifiers, key=len, reverse=True):
+            pattern = rf"\b{re.escape(ident)}(?:'s)?(?=\s|$)"
+            if re.search(pattern, rest):
+                key = self.identifiers[ident]
+                rest = re.sub(pattern, " ", rest, count=1)
+                break
+        if key is None or any(w not in LOOKUP_FILLER_WORDS for w in rest.split()):
+            return None
+        field = LOOKUP_FIELDS[field_word]
+
+        value = (self.patient_data[key].get("data") or {}).get(field)
+        label = field.replace("_", " ")
+        if isinstance(value, (list, tuple)):
+            # Skip template placeholders where every field is empty
+            value = [item for item in value if not isinstance(item, Mapping) or any(v not in (None, "") for v in item.values())]
+        if value in (None, "", [], {}):
+            return f"🩺 No {label} recorded for patient {key}."
+        if isinstance(value, Mapping):
+            body = "\n".join(f"- {k.replace('_', ' ')}: {v if v not in (None, '') else 'n/a'}" for k, v in value.items())
+        elif isinstance(value, list):
+            body = "\n".join(
+                "- " + ", ".join(f"{k}: {v}" for k, v in item.items() if v not in (None, "")) if isinstance(item, Mapping) else f"- {item}"
+                for item in value
+            )
+        else:
+            body = str(value)
+        return f"🩺 {label.capitalize()} for patient {key}:\n{body}"
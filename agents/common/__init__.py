@@ -0,0 +1 @@
+# Shared helpers used by more than one VitalMesh agent
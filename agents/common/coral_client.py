@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Persistent Coral connection for agents that answer other agents' messages.
+
+One MCP session over SSE is kept open to the Coral server and re-established
+with exponential backoff whenever it drops. Three kinds of task share it:
+
+  poller   calls coral_wait_for_mentions in a loop and puts each message on a
+           bounded inbox; when the inbox is full the poller stops asking
+           Coral for more, so unread messages wait server-side (backpressure)
+  workers  a fixed pool that takes messages off the inbox and awaits the
+           handler, so one slow answer does not hold up the others
+  sender   waits ``batch_window_s`` after the first outgoing message, then
+           sends everything queued meanwhile as concurrent coral_send_message
+           calls; messages that fail on a dead connection are kept and sent
+           again after reconnecting
+
+Any MCP server exposing the two Coral tools works, so a local stand-in
+server can be used in place of Coral.
+"""
+
+import asyncio
+import json
+import random
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+
+WAIT_FOR_MENTIONS = "coral_wait_for_mentions"
+SEND_MESSAGE = "coral_send_message"
+
+
+class CoralClient:
+    def __init__(self, connection_url: str, agent_id: str, handler: Callable[[Dict], Awaitable[None]],
+                 workers: int = 8, max_pending: int = 32, wait_timeout_ms: int = 30000,
+                 batch_window_s: float = 0.05, batch_max: int = 20,
+                 reconnect_min_s: float = 1.0, reconnect_max_s: float = 30.0):
+        self.connection_url = connection_url
+        self.agent_id = agent_id
+        self.handler = handler
+        self.workers = workers
+        self.wait_timeout_ms = wait_timeout_ms
+        self.batch_window_s = batch_window_s
+        self.batch_max = batch_max
+        self.reconnect_min_s = reconnect_min_s
+        self.reconnect_max_s = reconnect_max_s
+        self.inbox: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.connected = asyncio.Event()
+        self._outbox: deque = deque()
+        self._outbox_ready = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"received": 0, "handled": 0, "failed": 0, "sent": 0, "reconnects": 0}
+
+    async def run(self):
+        """Serve until cancelled, reconnecting whenever the session drops"""
+        self._tasks = [asyncio.create_task(self._worker(), name=f"coral-worker-{i}") for i in range(self.workers)]
+        backoff = self.reconnect_min_s
+        try:
+            while True:
+                try:
+                    async with sse_client(self.connection_url, timeout=10,
+                                          sse_read_timeout=self.wait_timeout_ms / 1000 + 60) as (read, write):
+                        async with ClientSession(read, write) as session:
+                            await session.initialize()
+                            print(f"🌊 Connected to Coral as {self.agent_id}")
+                            self.connected.set()
+                            backoff = self.reconnect_min_s
+                            await self._serve(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️  Coral connection lost ({type(e).__name__}: {e}); reconnecting in {backoff:.0f}s")
+                self.connected.clear()
+                self.stats["reconnects"] += 1
+                await asyncio.sleep(backoff * random.uniform(0.8, 1.2))
+                backoff = min(backoff * 2, self.reconnect_max_s)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            self.connected.clear()
+
+    async def _serve(self, session: ClientSession):
+        poller = asyncio.create_task(self._poll(session))
+        sender = asyncio.create_task(self._send_batches(session))
+        try:
+            # Either task failing means the session is unusable
+            done, _ = await asyncio.wait({poller, sender}, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            poller.cancel()
+            sender.cancel()
+            await asyncio.gather(poller, sender, return_exceptions=True)
+
+    async def _call(self, session: ClientSession, tool: str, arguments: Dict) -> Dict:
+        result = await session.call_tool(tool, arguments)
+        text = "".join(getattr(part, "text", "") for part in result.content or [])
+        try:
+            return json.loads(text) if text else {}
+        except ValueError:
+            return {"result": "error", "message": text}
+
+    async def _poll(self, session: ClientSession):
+        while True:
+            result = await self._call(session, WAIT_FOR_MENTIONS, {"timeoutMs": self.wait_timeout_ms})
+            if result.get("result") == "error":
+                print(f"⚠️  Coral wait_for_mentions failed: {result.get('message')}")
+                await asyncio.sleep(1)
+                continue
+            for message in result.get("messages") or []:
+                if message.get("senderId") == self.agent_id:
+                    continue
+                self.stats["received"] += 1
+                # Blocks while every worker is busy and the inbox is full
+                await self.inbox.put(message)
+
+    async def _worker(self):
+        while True:
+            message = await self.inbox.get()
+            try:
+                await self.handler(message)
+                self.stats["handled"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"❌ Error handling Coral message {message.get('id')}: {e}")
+            finally:
+                self.inbox.task_done()
+
+    def send(self, thread_id: str, content: str, mentions: Optional[List[str]] = None):
+        """Queue a message for the thread; it goes out with the next batch"""
+        self._outbox.append({"threadId": thread_id, "content": content, "mentions": list(mentions or [])})
+        self._outbox_ready.set()
+
+    async def _send_batches(self, session: ClientSession):
+        while True:
+            await self._outbox_ready.wait()
+            # Give replies finishing at about the same time a chance to join the batch
+            await asyncio.sleep(self.batch_window_s)
+            batch = [self._outbox.popleft() for _ in range(min(len(self._outbox), self.batch_max))]
+            if not self._outbox:
+                self._outbox_ready.clear()
+
+            results = await asyncio.gather(*(self._call(session, SEND_MESSAGE, args) for args in batch),
+                                           return_exceptions=True)
+            failed = []
+            for args, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    failed.append(args)
+                elif result.get("result") in ("error", "tool_input_error"):
+                    print(f"❌ Coral rejected message to thread {args['threadId']}: {result.get('message')}")
+                else:
+                    self.stats["sent"] += 1
+            if failed:
+                # Keep them at the front, in order, for the next connection
+                self._outbox.extendleft(reversed(failed))
+                self._outbox_ready.set()
+                raise ConnectionError(f"{len(failed)} message(s) not sent")
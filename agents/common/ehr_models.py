@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Compact in-memory representation of EHR records.
+
+``yaml.safe_load`` gives a tree of dicts and lists in which every record
+repeats its key strings and carries the template's null fields. The classes
+here use ``__slots__`` instead of a per-record dict, store lists as tuples,
+leave null and empty fields unset, drop the template's all-null list rows
+and intern the enum-like fields (urgency_level, severity, priority, gender)
+so each distinct value exists once.
+
+Records stay read-compatible with the dict trees they replace: they are
+``Mapping``s (``get``, ``items``, ``in``, iteration skip unset fields), unset
+fields read as ``None`` through attribute access, and ``yaml.dump`` writes
+them as plain mappings. Keys outside the schema are kept in ``extra``, so
+``to_dict`` gives back the loaded data minus its nulls.
+"""
+
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import yaml
+
+URGENCY_LEVELS = ("low", "medium", "high", "critical")
+SEVERITIES = ("mild", "moderate", "severe", "critical")
+PRIORITIES = ("low", "medium", "high", "urgent", "immediate")
+GENDERS = ("male", "female", "other", "unknown")
+
+
+def intern_value(value: Any, vocabulary: Tuple[str, ...]) -> Any:
+    """The shared canonical string for an enum-like value; other strings are interned as given"""
+    if not isinstance(value, str):
+        return value
+    value = value.strip()
+    canonical = value.lower()
+    for known in vocabulary:
+        if known == canonical:
+            return known
+    return sys.intern(value)
+
+
+def _absent(value: Any) -> bool:
+    if value is None or value == "":
+        return True
+    return isinstance(value, (Mapping, list, tuple)) and len(value) == 0
+
+
+def _is_set(record: Any, name: str) -> bool:
+    try:
+        object.__getattribute__(record, name)
+    except AttributeError:
+        return False
+    return True
+
+
+def _compact(value: Any) -> Any:
+    """Plain YAML data with nulls dropped and lists as tuples"""
+    if isinstance(value, Mapping):
+        return {k: c for k, c in ((k, _compact(v)) for k, v in value.items()) if not _absent(c)}
+    if isinstance(value, list):
+        return tuple(c for c in (_compact(v) for v in value) if not _absent(c))
+    return value
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, SlottedRecord):
+        return value.to_dict()
+    if isinstance(value, Mapping):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    return value
+
+
+class SlottedRecord(Mapping):
+    __slots__ = ("extra",)
+    # Schema fields, in output order
+    FIELDS: Tuple[str, ...] = ()
+    # Fields holding one nested record / a list of records
+    NESTED: Dict[str, type] = {}
+    LISTS: Dict[str, type] = {}
+    # Enum-like fields and their vocabularies
+    INTERNED: Dict[str, Tuple[str, ...]] = {}
+
+    @classmethod
+    def from_dict(cls, data: Any) -> Optional["SlottedRecord"]:
+        if not isinstance(data, Mapping):
+            return None
+        record = cls.__new__(cls)
+        extra = {}
+        for key, value in data.items():
+            value = cls._convert(key, value)
+            if _absent(value):
+                continue
+            if key in cls.FIELDS:
+                object.__setattr__(record, key, value)
+            else:
+                extra[key] = value
+        if extra:
+            record.extra = extra
+        return record
+
+    @classmethod
+    def _convert(cls, key: str, value: Any) -> Any:
+        if key in cls.NESTED:
+            return cls.NESTED[key].from_dict(value) if isinstance(value, Mapping) else _compact(value)
+        if key in cls.LISTS and isinstance(value, list):
+            item_cls = cls.LISTS[key]
+            items = (item_cls.from_dict(v) if isinstance(v, Mapping) else _compact(v) for v in value)
+            return tuple(item for item in items if not _absent(item))
+        if key in cls.INTERNED:
+            return intern_value(value, cls.INTERNED[key])
+        return _compact(value)
+
+    @classmethod
+    def from_yaml(cls, text: str) -> Optional["SlottedRecord"]:
+        return cls.from_dict(yaml.safe_load(text))
+
+    def __getattr__(self, name: str) -> Any:
+        # Only reached for unset slots and unknown names
+        if name in type(self).FIELDS:
+            return None
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def __getitem__(self, key: str) -> Any:
+        if key in type(self).FIELDS:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        try:
+            return object.__getattribute__(self, "extra")[key]
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self) -> Iterator[str]:
+        for name in type(self).FIELDS:
+            if _is_set(self, name):
+                yield name
+        if _is_set(self, "extra"):
+            yield from object.__getattribute__(self, "extra")
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Unset fields must stay unset rather than come back as None
+        return {name: object.__getattribute__(self, name)
+                for name in ("extra",) + type(self).FIELDS if _is_set(self, name)}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        for name, value in state.items():
+            if name in type(self).INTERNED:
+                # Unpickled strings are fresh copies; share the canonical ones again
+                value = intern_value(value, type(self).INTERNED[name])
+            object.__setattr__(self, name, value)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: _plain(value) for key, value in self.items()}
+
+    def to_yaml(self) -> str:
+        return yaml.dump(self.to_dict(), default_flow_style=False, sort_keys=False)
+
+
+class PatientInfo(SlottedRecord):
+    __slots__ = ("patient_id", "name", "age", "gender", "contact")
+    FIELDS = __slots__
+    INTERNED = {"gender": GENDERS}
+
+
+class Symptom(SlottedRecord):
+    __slots__ = ("symptom", "severity", "duration", "notes")
+    FIELDS = __slots__
+    INTERNED = {"severity": SEVERITIES}
+
+
+class Vitals(SlottedRecord):
+    __slots__ = ("temperature", "blood_pressure", "heart_rate", "respiratory_rate", "oxygen_saturation")
+    FIELDS = __slots__
+
+
+class HistoryItem(SlottedRecord):
+    __slots__ = ("condition", "date", "notes")
+    FIELDS = __slots__
+
+
+class Assessment(SlottedRecord):
+    __slots__ = ("primary_diagnosis", "differential_diagnoses", "clinical_notes")
+    FIELDS = __slots__
+
+
+class Recommendation(SlottedRecord):
+    __slots__ = ("action", "priority", "timeframe")
+    FIELDS = __slots__
+    INTERNED = {"priority": PRIORITIES}
+
+
+class EHRRecord(SlottedRecord):
+    __slots__ = ("patient_info", "chief_complaint", "symptoms", "vitals", "medical_history",
+                 "assessment", "recommendations", "urgency_level", "generated_at")
+    FIELDS = __slots__
+    NESTED = {"patient_info": PatientInfo, "vitals": Vitals, "assessment": Assessment}
+    LISTS = {"symptoms": Symptom, "medical_history": HistoryItem, "recommendations": Recommendation}
+    INTERNED = {"urgency_level": URGENCY_LEVELS}
+
+
+def _represent_record(dumper: yaml.Dumper, record: SlottedRecord):
+    return dumper.represent_dict(record.to_dict())
+
+
+for _dumper in (yaml.Dumper, yaml.SafeDumper):
+    yaml.add_multi_representer(SlottedRecord, _represent_record, Dumper=_dumper)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Compiled, memory-mapped snapshot of the EHR corpus.
+
+Parsing every EHR YAML file is what makes a chatbot process slow to start and
+large in memory, and each backend worker used to do it separately. Instead the
+first process to find the corpus changed compiles it into one binary file, and
+every process maps that file read-only. Pages are shared through the page
+cache and a record is only unpickled when it is accessed.
+
+Layout (native byte order, sections 8-byte aligned):
+
+    header          magic, format version, record count, corpus fingerprint,
+                    offsets of the four sections below
+    key offsets     (count + 1) uint64 into the key blob
+    key blob        UTF-8 keys, sorted bytewise, so lookups binary search the map
+    record offsets  (count + 1) uint64 into the record blob
+    record blob     one pickle per record
+
+The fingerprint is a hash of the source files' names, sizes and mtimes. A
+rebuild is written to a temporary file and renamed over the old snapshot
+under an exclusive flock, so only one process compiles at a time and readers
+always see a complete file.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+from array import array
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple
+
+MAGIC = b"EHRSNAP1"
+FORMAT_VERSION = 1
+_HEADER = struct.Struct("=8sII20s4x4Q")
+
+
+def corpus_fingerprint(paths: Sequence[Path]) -> bytes:
+    """Hash of names, sizes and mtimes; changes whenever a file is added, removed or rewritten"""
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        digest.update(f"{Path(path).name}\0{st.st_size}\0{st.st_mtime_ns}\n".encode("utf-8"))
+    return digest.digest()
+
+
+def _pad(f, alignment: int = 8):
+    f.write(b"\0" * (-f.tell() % alignment))
+
+
+def write_snapshot(path: Path, records: Iterable[Tuple[str, Any]], fingerprint: bytes) -> int:
+    """Compile (key, record) pairs, sorted by key, into a snapshot file; returns the record count"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    keys, record_offsets = [], array("Q", [0])
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * _HEADER.size)
+        _pad(f)
+        records_pos = f.tell()
+        previous = None
+        for key, record in records:
+            encoded = key.encode("utf-8")
+            if previous is not None and encoded <= previous:
+                raise ValueError(f"snapshot keys must be unique and sorted, got {key!r} after {previous!r}")
+            previous = encoded
+            keys.append(encoded)
+            f.write(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+            record_offsets.append(f.tell() - records_pos)
+
+        _pad(f)
+        record_offsets_pos = f.tell()
+        f.write(record_offsets.tobytes())
+
+        key_offsets = array("Q", [0])
+        for encoded in keys:
+            key_offsets.append(key_offsets[-1] + len(encoded))
+        key_offsets_pos = f.tell()
+        f.write(key_offsets.tobytes())
+        keys_pos = f.tell()
+        f.write(b"".join(keys))
+
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(keys), fingerprint,
+                             key_offsets_pos, keys_pos, record_offsets_pos, records_pos))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class EHRSnapshot:
+    """Read-only mapping of key -> record backed by a mapped snapshot file"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, self.fingerprint, key_offsets_pos, keys_pos, record_offsets_pos, records_pos = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{self.path} is not a version {FORMAT_VERSION} EHR snapshot")
+        view = memoryview(self._mm)
+        self._key_offsets = view[key_offsets_pos:key_offsets_pos + 8 * (self._count + 1)].cast("Q")
+        self._keys_pos = keys_pos
+        self._record_offsets = view[record_offsets_pos:record_offsets_pos + 8 * (self._count + 1)].cast("Q")
+        self._records_pos = records_pos
+        self.decodes = 0
+
+    def _key(self, i: int) -> bytes:
+        return self._mm[self._keys_pos + self._key_offsets[i]:self._keys_pos + self._key_offsets[i + 1]]
+
+    def _find(self, key: str) -> int:
+        target = key.encode("utf-8")
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._count and self._key(lo) == target else -1
+
+    def _record(self, i: int) -> Any:
+        self.decodes += 1
+        start = self._records_pos + self._record_offsets[i]
+        return pickle.loads(self._mm[start:self._records_pos + self._record_offsets[i + 1]])
+
+    def get(self, key: str, default: Any = None) -> Any:
+        i = self._find(key)
+        return self._record(i) if i >= 0 else default
+
+    def __getitem__(self, key: str) -> Any:
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._record(i)
+
+    def __contains__(self, key: str) -> bool:
+        return isinstance(key, str) and self._find(key) >= 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._key(i).decode("utf-8") for i in range(self._count))
+
+    def keys(self):
+        return list(self)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        for i in range(self._count):
+            yield self._key(i).decode("utf-8"), self._record(i)
+
+    def values(self) -> Iterator[Any]:
+        for _, record in self.items():
+            yield record
+
+    def is_stale(self) -> bool:
+        """Whether another process has replaced the snapshot file since it was mapped"""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except OSError:
+            return False
+
+    def metrics(self):
+        return {"records": self._count, "mapped_bytes": len(self._mm), "decodes": self.decodes}
+
+    def close(self):
+        """Unmap the file; the snapshot must not be read afterwards"""
+        if self._mm.closed:
+            return
+        self._key_offsets.release()
+        self._record_offsets.release()
+        self._mm.close()
+
+    def report(self):
+        print(f"🗺️  Snapshot {self.path.name}: {self._count} records, {len(self._mm) / 1e6:.1f} MB mapped, "
+              f"{self.decodes} records decoded")
+
+
+def open_snapshot(path: Path) -> Optional[EHRSnapshot]:
+    try:
+        return EHRSnapshot(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def load_or_build(path: Path, fingerprint: bytes, build: Callable[[], Iterable[Tuple[str, Any]]]) -> EHRSnapshot:
+    """Map the snapshot at ``path``, compiling it from ``build()`` first if it is missing or out of date"""
+    path = Path(path)
+    snapshot = open_snapshot(path)
+    if snapshot is not None and snapshot.fingerprint == fingerprint:
+        return snapshot
+    if snapshot is not None:
+        snapshot.close()
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another worker may have compiled it while we waited for the lock
+            snapshot = open_snapshot(path)
+            if snapshot is not None and snapshot.fingerprint == fingerprint:
+                return snapshot
+            if snapshot is not None:
+                snapshot.close()
+            count = write_snapshot(path, build(), fingerprint)
+            print(f"🗺️  Compiled EHR snapshot with {count} records: {path}")
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return EHRSnapshot(path)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Compact canonical summaries of EHR records.
+
+A summary is one short line per patient with only the populated fields, in a
+fixed order, e.g.
+
+    Hayden, 34 M | CC: broken hip | Sx: pain in hip (severe, 2 days); sharp pain | Urgency: high
+
+The EHR agent writes one next to every EHR it saves (``summaries/<stem>.txt``
+under the output directory) so cross-patient questions can put a few dozen
+tokens per patient into the prompt instead of the full YAML dump.
+"""
+
+import os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SUMMARY_DIR = "summaries"
+MAX_ITEMS = 5
+MAX_TEXT = 120
+
+
+def _present(value: Any) -> bool:
+    return value not in (None, "", [], {})
+
+
+def _clip(value: Any, limit: int = MAX_TEXT) -> str:
+    text = " ".join(str(value).split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+def _items(entries: Any, key: str, details: List[str]) -> List[str]:
+    """Format list sections as 'name (detail, detail)', skipping empty template rows"""
+    formatted = []
+    for entry in entries if isinstance(entries, (list, tuple)) else []:
+        if not isinstance(entry, Mapping):
+            if _present(entry):
+                formatted.append(_clip(entry, 60))
+            continue
+        if not _present(entry.get(key)):
+            continue
+        extras = [_clip(entry[d], 40) for d in details if _present(entry.get(d))]
+        formatted.append(_clip(entry[key], 60) + (f" ({', '.join(extras)})" if extras else ""))
+    if len(formatted) > MAX_ITEMS:
+        formatted = formatted[:MAX_ITEMS] + [f"+{len(formatted) - MAX_ITEMS} more"]
+    return formatted
+
+
+def summarize_ehr(ehr: Optional[Dict]) -> str:
+    if not isinstance(ehr, Mapping):
+        return "No structured record"
+    info = ehr.get("patient_info") or {}
+    demographics = " ".join(str(info[k]) for k in ("age", "gender") if _present(info.get(k)))
+    parts = [", ".join(p for p in (str(info.get("name") or "Unknown name"), demographics) if p)]
+
+    if _present(ehr.get("chief_complaint")):
+        parts.append(f"CC: {_clip(ehr['chief_complaint'])}")
+    symptoms = _items(ehr.get("symptoms"), "symptom", ["severity", "duration"])
+    if symptoms:
+        parts.append(f"Sx: {'; '.join(symptoms)}")
+
+    vitals = ehr.get("vitals") or {}
+    if isinstance(vitals, Mapping):
+        readings = [f"{k.replace('_', ' ')} {v}" for k, v in vitals.items() if _present(v)]
+        if readings:
+            parts.append(f"Vitals: {', '.join(readings)}")
+
+    history = _items(ehr.get("medical_history"), "condition", ["date"])
+    if history:
+        parts.append(f"Hx: {'; '.join(history)}")
+
+    assessment = ehr.get("assessment") or {}
+    if isinstance(assessment, Mapping) and _present(assessment.get("primary_diagnosis")):
+        parts.append(f"Dx: {_clip(assessment['primary_diagnosis'])}")
+    plan = _items(ehr.get("recommendations"), "action", ["priority", "timeframe"])
+    if plan:
+        parts.append(f"Plan: {'; '.join(plan)}")
+    if _present(ehr.get("urgency_level")):
+        parts.append(f"Urgency: {ehr['urgency_level']}")
+    return " | ".join(parts)
+
+
+def summary_path(ehr_path: Path) -> Path:
+    ehr_path = Path(ehr_path)
+    return ehr_path.parent / SUMMARY_DIR / f"{ehr_path.stem}.txt"
+
+
+def write_summary(ehr_path: Path, ehr: Optional[Dict]) -> Path:
+    """Write the summary for an EHR file atomically and return its path"""
+    path = summary_path(ehr_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(summarize_ehr(ehr) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_summary(ehr_path: Path, ehr: Optional[Dict]) -> str:
+    """Stored summary if it is at least as new as the EHR file, otherwise computed on the spot"""
+    path = summary_path(ehr_path)
+    try:
+        if path.stat().st_mtime >= Path(ehr_path).stat().st_mtime:
+            return path.read_text().strip()
+    except OSError:
+        pass
+    return summarize_ehr(ehr)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Durable on-disk handoff queue between the medical (voice) agent and the EHR agent.
+
+The patient notes file stays the source of truth; the queue only carries a
+small message per completed session saying which notes file changed. Messages
+move through three states using atomic renames:
+
+    tmp/  ->  pending/  ->  processing/  ->  (deleted on ack)
+
+A consumer that crashes mid-message leaves it in processing/, and recover()
+puts it back in pending/ on restart, so every message is processed until it
+is acknowledged. A nacked message counts the attempt and waits out an
+exponential backoff before it can be claimed again; the pending file's mtime
+holds the time it becomes due. The producer also pokes a Unix domain socket
+after each enqueue so a listening consumer wakes up immediately instead of
+waiting for its next poll.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SOCKET_NAME = "ehr.sock"
+
+
+class HandoffQueue:
+    def __init__(self, queue_dir: str, retry_base_s: float = 30.0, retry_max_s: float = 900.0):
+        self.queue_dir = Path(queue_dir)
+        self.retry_base_s = retry_base_s
+        self.retry_max_s = retry_max_s
+        self.tmp_dir = self.queue_dir / "tmp"
+        self.pending_dir = self.queue_dir / "pending"
+        self.processing_dir = self.queue_dir / "processing"
+        for directory in (self.tmp_dir, self.pending_dir, self.processing_dir):
+            directory.mkdir(parents=True, exist_ok=True)
+        self.socket_path = self.queue_dir / SOCKET_NAME
+
+    # Producer side
+
+    def enqueue(self, message: Dict) -> str:
+        """Durably enqueue a message and wake the consumer if it is listening"""
+        message_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        message = {**message, "id": message_id, "enqueued_at": time.time()}
+
+        tmp_path = self.tmp_dir / f"{message_id}.json"
+        with open(tmp_path, "w") as f:
+            json.dump(message, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.pending_dir / tmp_path.name)
+        _fsync_dir(self.pending_dir)
+
+        self.notify()
+        return message_id
+
+    def notify(self):
+        """Best-effort wake-up; the consumer still finds the message on its next poll"""
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(0.2)
+                sock.connect(str(self.socket_path))
+                sock.sendall(b"\n")
+        except OSError:
+            pass
+
+    # Consumer side
+
+    def recover(self, stale_after: Optional[float] = None) -> int:
+        """Return messages left in processing/ by a crashed consumer to pending/
+
+        With several consumers sharing the queue, pass ``stale_after`` so only
+        messages claimed longer ago than that many seconds are taken back.
+        """
+        recovered = 0
+        now = time.time()
+        for path in self.processing_dir.glob("*.json"):
+            try:
+                if stale_after is not None and now - path.stat().st_mtime < stale_after:
+                    continue
+                os.rename(path, self.pending_dir / path.name)
+                recovered += 1
+            except FileNotFoundError:
+                pass
+        return recovered
+
+    def claim(self, limit: Optional[int] = None) -> List[Tuple[Path, Dict]]:
+        """Move due pending messages to processing/, oldest first, and return them"""
+        claimed = []
+        now = time.time()
+        for name in sorted(os.listdir(self.pending_dir)):
+            if limit is not None and len(claimed) >= limit:
+                break
+            if not name.endswith(".json"):
+                continue
+            try:
+                if os.stat(self.pending_dir / name).st_mtime > now:
+                    # Backing off after a failed attempt
+                    continue
+            except FileNotFoundError:
+                continue
+            target = self.processing_dir / name
+            try:
+                os.rename(self.pending_dir / name, target)
+                # The mtime marks when it was claimed, for recover(stale_after=...)
+                os.utime(target)
+            except FileNotFoundError:
+                # Claimed by another consumer
+                continue
+            try:
+                with open(target, "r") as f:
+                    claimed.append((target, json.load(f)))
+            except (OSError, ValueError):
+                # Unreadable message: drop it, the notes file is still on disk
+                target.unlink(missing_ok=True)
+        return claimed
+
+    def ack(self, path: Path):
+        Path(path).unlink(missing_ok=True)
+
+    def nack(self, path: Path) -> float:
+        """Return a message to pending/ for a retry after a backoff; returns the delay in seconds"""
+        path = Path(path)
+        try:
+            with open(path, "r") as f:
+                message = json.load(f)
+        except (OSError, ValueError):
+            message = None
+        delay = 0.0
+        if message is not None:
+            message["attempts"] = message.get("attempts", 0) + 1
+            delay = min(self.retry_max_s, self.retry_base_s * 2 ** (message["attempts"] - 1))
+            # Rewrite in place with the attempt count, then move it back atomically
+            tmp_path = self.tmp_dir / path.name
+            with open(tmp_path, "w") as f:
+                json.dump(message, f)
+            os.replace(tmp_path, path)
+        due = time.time() + delay
+        try:
+            os.utime(path, (due, due))
+            os.rename(path, self.pending_dir / path.name)
+        except FileNotFoundError:
+            pass
+        return delay
+
+    def pending_count(self) -> int:
+        return sum(1 for name in os.listdir(self.pending_dir) if name.endswith(".json"))
+
+    async def listen(self, wake_event: asyncio.Event) -> asyncio.AbstractServer:
+        """Set ``wake_event`` whenever a producer pokes the socket"""
+        self.socket_path.unlink(missing_ok=True)
+
+        async def _on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            wake_event.set()
+            writer.close()
+
+        return await asyncio.start_unix_server(_on_connect, path=str(self.socket_path))
+
+
+def _fsync_dir(directory: Path):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
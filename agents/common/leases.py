@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+File-based leases so several EHR agent workers can share one notes directory.
+
+A lease is a small JSON file created with O_CREAT | O_EXCL, which is atomic
+on local filesystems and on NFSv3+; whoever creates it owns the resource
+until the lease expires. Held leases are renewed by a heartbeat thread, so a
+lease only expires when its worker has crashed or hung, and another worker
+may then take it over:
+
+    1. rename the expired lease to a private name (only one taker wins)
+    2. check the renamed file is the expired lease it judged, not a fresh one
+       that replaced it meanwhile; if it is fresh, link it back and give up
+    3. create a new lease with O_EXCL
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseManager:
+    def __init__(self, lease_dir: str, worker_id: Optional[str] = None, ttl_seconds: float = 900):
+        self.lease_dir = Path(lease_dir)
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl_seconds = ttl_seconds
+        self._held: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._heartbeat: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def _path(self, name: str) -> Path:
+        return self.lease_dir / f"{name}.lease"
+
+    def _read(self, path: Path) -> Optional[Dict]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _create(self, path: Path, token: str) -> bool:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker_id, "token": token, "expires": time.time() + self.ttl_seconds}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def try_acquire(self, name: str) -> bool:
+        """Take the lease on ``name`` unless a live worker holds it"""
+        path = self._path(name)
+        token = uuid.uuid4().hex
+        if not self._create(path, token):
+            current = self._read(path)
+            # A lease being written has no content yet; treat it as live
+            if current is None or current.get("expires", 0) > time.time():
+                return False
+            if not self._take_over(path, current) or not self._create(path, token):
+                return False
+
+        with self._lock:
+            self._held[name] = token
+        self._ensure_heartbeat()
+        return True
+
+    def _take_over(self, path: Path, expired: Dict) -> bool:
+        private = path.with_name(f"{path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(path, private)
+        except FileNotFoundError:
+            # Another worker took it over first
+            return True
+        taken = self._read(private)
+        if taken is not None and taken.get("token") != expired.get("token"):
+            # Renamed a fresh lease created after our read: put it back if nothing replaced it
+            try:
+                os.link(private, path)
+            except FileExistsError:
+                pass
+            os.unlink(private)
+            return False
+        os.unlink(private)
+        print(f"♻️  Took over expired lease {path.stem} from {expired.get('worker')}")
+        return True
+
+    def release(self, name: str):
+        with self._lock:
+            token = self._held.pop(name, None)
+        if token is None:
+            return
+        path = self._path(name)
+        current = self._read(path)
+        if current is not None and current.get("token") == token:
+            path.unlink(missing_ok=True)
+
+    def renew(self):
+        """Push back the expiry of every lease this worker holds"""
+        with self._lock:
+            held = dict(self._held)
+        for name, token in held.items():
+            path = self._path(name)
+            current = self._read(path)
+            if current is None or current.get("token") != token:
+                # Lost it (expired and taken over); the work will be redone by the new holder
+                with self._lock:
+                    self._held.pop(name, None)
+                continue
+            tmp_path = path.with_name(f"{path.name}.{token}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({**current, "expires": time.time() + self.ttl_seconds}, f)
+            os.replace(tmp_path, path)
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+
+        def beat():
+            while not self._stopped.wait(self.ttl_seconds / 3):
+                try:
+                    self.renew()
+                except OSError as e:
+                    print(f"⚠️  Lease renewal failed: {e}")
+
+        self._heartbeat = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            names = list(self._held)
+        for name in names:
+            self.release(name)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Append-only, crash-safe key/value ledger.
+
+Used by the EHR agent to remember which patient notes files have been turned
+into EHRs. State is a YAML snapshot plus a JSON-lines log of changes since
+that snapshot:
+
+    processed_mapping.yaml     compacted snapshot (written to .tmp, fsync'd, renamed)
+    processed_ledger.jsonl     one fsync'd {"key": ..., "value": ...} line per commit
+
+On open the snapshot is loaded and the log replayed over it, last write wins;
+a torn final line from a crash is ignored. A commit appends a single line, so
+its cost does not grow with the number of entries. Every ``compact_every``
+commits the in-memory state is written as a new snapshot and the log is
+replaced by an empty one. A crash between the two renames is harmless because
+replaying the old log over the new snapshot gives the same state.
+
+Several processes can share a ledger. Writers hold an exclusive flock on
+``<log>.lock`` while appending or compacting, readers a shared one while
+replaying, and ``refresh()`` picks up lines other processes appended. Each
+log starts with a random generation header; after a compaction swaps in a new
+log, readers see a different generation and reload from the snapshot.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict
+
+import yaml
+
+_UNLOADED = object()
+
+
+class Ledger:
+    def __init__(self, log_path: Path, snapshot_path: Path, compact_every: int = 500):
+        self.log_path = Path(log_path)
+        self.snapshot_path = Path(snapshot_path)
+        self.lock_path = self.log_path.with_name(self.log_path.name + ".lock")
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Any] = {}
+        self._generation = _UNLOADED
+        self._log_offset = 0
+        self._log_entries = 0
+        self.refresh()
+        if self._log_entries >= self.compact_every:
+            self.compact()
+
+    @contextmanager
+    def _file_lock(self, mode: int):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """Apply changes committed by other processes since the last refresh"""
+        with self._lock, self._file_lock(fcntl.LOCK_SH):
+            self._replay()
+
+    def _replay(self):
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            if self._generation is _UNLOADED:
+                self._reload_snapshot(None, 0)
+            return
+
+        with f:
+            header = f.readline()
+            generation = _parse_generation(header)
+            if generation != self._generation or self._generation is _UNLOADED:
+                # First load, or the log was compacted: start again from the snapshot
+                self._reload_snapshot(generation, len(header) if generation else 0)
+            f.seek(self._log_offset)
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash; nothing after it was acknowledged
+                    break
+                self._apply(self.entries, record)
+                self._log_entries += 1
+                self._log_offset += len(line)
+
+    def _reload_snapshot(self, generation, offset: int):
+        entries = {}
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, "r") as f:
+                entries = yaml.safe_load(f) or {}
+        # Update in place so callers holding the dict see the new state
+        self.entries.clear()
+        self.entries.update(entries)
+        self._generation, self._log_offset, self._log_entries = generation, offset, 0
+
+    @staticmethod
+    def _apply(entries: Dict[str, Any], record: Dict):
+        if "generation" in record:
+            return
+        if record.get("deleted"):
+            entries.pop(record["key"], None)
+        else:
+            entries[record["key"]] = record["value"]
+
+    def commit(self, key: str, value: Any):
+        """Durably record ``key -> value`` before returning"""
+        self._append({"key": key, "value": value})
+
+    def delete(self, key: str):
+        self._append({"key": key, "deleted": True})
+
+    def _append(self, record: Dict):
+        line = (json.dumps(record, default=str) + "\n").encode("utf-8")
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._replay()
+            with open(self.log_path, "ab") as f:
+                if f.tell() > self._log_offset:
+                    # Drop a torn tail so this record starts on a clean line
+                    f.truncate(self._log_offset)
+                if self._log_offset == 0:
+                    header = _generation_header()
+                    f.write(header)
+                    self._generation, self._log_offset = _parse_generation(header), len(header)
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(self.entries, record)
+            self._log_entries += 1
+            self._log_offset += len(line)
+            if self._log_entries >= self.compact_every:
+                self._compact()
+
+    def compact(self):
+        """Write the current state as the snapshot and start an empty log"""
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._replay()
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.snapshot_path.with_suffix(self.snapshot_path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            yaml.dump(self.entries, f, default_flow_style=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        header = _generation_header()
+        empty_log = self.log_path.with_suffix(self.log_path.suffix + ".tmp")
+        with open(empty_log, "wb") as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(empty_log, self.log_path)
+        _fsync_dir(self.snapshot_path.parent)
+        self._generation, self._log_offset, self._log_entries = _parse_generation(header), len(header), 0
+
+
+def _generation_header() -> bytes:
+    return (json.dumps({"generation": uuid.uuid4().hex}) + "\n").encode("utf-8")
+
+
+def _parse_generation(header: bytes):
+    try:
+        return json.loads(header).get("generation") if header.endswith(b"\n") else None
+    except (ValueError, AttributeError):
+        return None
+
+
+def _fsync_dir(directory: Path):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Shared gateway for LLM calls made by the VitalMesh agents.
+
+Every chat completion goes through one process-wide gateway that provides:
+  - a token-bucket limiter on requests and tokens per minute, shared by all callers
+  - per-caller priority, so voice turns are served before chatbot queries and
+    both before background EHR backfill (which also leaves a reserve untouched)
+  - jittered exponential retry on 429 / 5xx / connection errors
+  - one pooled keep-alive HTTP client per provider, and one async client per
+    provider and priority for each event loop
+  - optional hedging to a secondary provider when the primary is slow to produce
+    its first token, with a circuit breaker per provider for failover
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+import httpx
+
+
+class Priority:
+    VOICE = 0
+    INTERACTIVE = 1
+    BACKGROUND = 2
+
+
+PROVIDER_BASE_URLS = {
+    "groq": "https://api.groq.com/openai/v1",
+    "openai": "https://api.openai.com/v1",
+}
+
+RETRYABLE_ERRORS = ("APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout")
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int) -> int:
+    """Rough prompt + completion token estimate (about 4 characters per token)"""
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+    return prompt_chars // 4 + max_tokens
+
+
+class TokenBucketLimiter:
+    """Requests-per-minute and tokens-per-minute buckets with priority-ordered waiters"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, background_reserve: float = 0.2):
+        self.capacity = {"requests": float(requests_per_minute), "tokens": float(tokens_per_minute)}
+        self.levels = dict(self.capacity)
+        self.background_reserve = background_reserve
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        for key, capacity in self.capacity.items():
+            self.levels[key] = min(capacity, self.levels[key] + capacity * elapsed / 60.0)
+
+    def _needed(self, tokens: int, priority: int) -> Dict[str, float]:
+        reserve = self.background_reserve if priority >= Priority.BACKGROUND else 0.0
+        return {
+            "requests": min(self.capacity["requests"], 1 + reserve * self.capacity["requests"]),
+            "tokens": min(self.capacity["tokens"], tokens + reserve * self.capacity["tokens"]),
+        }
+
+    def acquire(self, tokens: int, priority: int = Priority.INTERACTIVE):
+        """Block until the request may be sent; higher priority waiters always go first"""
+        tokens = min(tokens, self.capacity["tokens"])
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    needed = self._needed(tokens, priority)
+                    if self._waiters[0] == ticket and all(self.levels[k] >= v for k, v in needed.items()):
+                        self.levels["requests"] -= 1
+                        self.levels["tokens"] -= tokens
+                        return
+                    # Sleep until the larger deficit would be refilled, re-checking on every release
+                    deficit = max(
+                        (needed[k] - self.levels[k]) / self.capacity[k] * 60.0 for k in needed
+                    )
+                    self._cond.wait(timeout=min(max(deficit, 0.01), 1.0))
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def adjust(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token bucket once the real usage is known"""
+        with self._cond:
+            self.levels["tokens"] = min(self.capacity["tokens"], self.levels["tokens"] + estimated_tokens - actual_tokens)
+            self._cond.notify_all()
+
+
+class _Cancellation:
+    """Cancellation flag for the legs of one call, also set when the caller's own event is"""
+
+    def __init__(self, parent: Optional[threading.Event] = None):
+        self._event = threading.Event()
+        self._parent = parent
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self) -> bool:
+        return self._event.is_set() or (self._parent is not None and self._parent.is_set())
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a provider whose circuit breaker is rejecting traffic"""
+
+
+class CircuitBreaker:
+    """Stops sending traffic to a failing provider for ``reset_timeout`` seconds
+
+    After the timeout the breaker is half-open: exactly one call is let through
+    as a probe and the rest are rejected until it succeeds (closing the
+    breaker) or fails (reopening it).
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call would currently be let through (does not claim the probe)"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            return not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def acquire(self) -> Optional[str]:
+        """Claim a call: "closed", "probe" for the single half-open probe, or None if rejected"""
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return None
+            self.probing = True
+            return "probe"
+
+    def release_probe(self):
+        """Give up a probe that ended without a success or failure, e.g. when cancelled"""
+        with self._lock:
+            self.probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class Provider:
+    """One LLM provider: SDK client, rate limiter, circuit breaker and first-token latencies"""
+
+    def __init__(self, name: str, api_key: str, model: Optional[str] = None):
+        self.name = name.lower()
+        self.api_key = api_key
+        # None means "use the model the caller asked for"
+        self.model = model
+        prefix = "LLM" if model is None else "LLM_SECONDARY"
+        self.limiter = TokenBucketLimiter(
+            requests_per_minute=float(os.getenv(f"{prefix}_RPM", "30")),
+            tokens_per_minute=float(os.getenv(f"{prefix}_TPM", "20000")),
+            background_reserve=float(os.getenv("LLM_BACKGROUND_RESERVE", "0.2")),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("LLM_BREAKER_RESET_S", "30")),
+        )
+        self.first_token_latencies = deque(maxlen=200)
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+        self._client = None
+
+    @property
+    def client(self):
+        """Provider SDK client, created on first use"""
+        if self._client is None:
+            # Retries are handled by the gateway so they respect the shared limiter
+            if self.name == "openai":
+                from openai import OpenAI
+                self._client = OpenAI(api_key=self.api_key, http_client=self.http_client, max_retries=0)
+            else:
+                from groq import Groq
+                self._client = Groq(api_key=self.api_key, http_client=self.http_client, max_retries=0)
+        return self._client
+
+    def first_token_percentile(self, pct: float) -> Optional[float]:
+        if len(self.first_token_latencies) < 10:
+            return None
+        ordered = sorted(self.first_token_latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class LLMGateway:
+    def __init__(self, provider: str = None, api_key: str = None):
+        self.max_retries = int(os.getenv("LLM_MAX_RETRIES", "4"))
+        self.primary = Provider(provider or os.getenv("LLM_PROVIDER", "groq"), api_key or os.getenv("API_KEY"))
+        self.providers = [self.primary]
+
+        # Optional second provider for hedged requests and failover
+        secondary = os.getenv("LLM_SECONDARY_PROVIDER")
+        if secondary:
+            secondary = secondary.lower()
+            default_model = "gpt-4o-mini" if secondary == "openai" else "llama-3.1-8b-instant"
+            self.providers.append(Provider(
+                secondary,
+                os.getenv("LLM_SECONDARY_API_KEY") or os.getenv(f"{secondary.upper()}_API_KEY"),
+                model=os.getenv("LLM_SECONDARY_MODEL", default_model),
+            ))
+
+        # Hedge once the primary is slower than this percentile of its recent first-token latencies
+        self.hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "90"))
+        self.hedge_min_delay = float(os.getenv("LLM_HEDGE_MIN_DELAY_S", "1.0"))
+        self.hedging = os.getenv("LLM_HEDGING", "true").lower() == "true" and len(self.providers) > 1
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-gateway")
+        # Async clients are bound to the loop that uses them, so they are shared per loop
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict]" = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    @property
+    def limiter(self) -> TokenBucketLimiter:
+        return self.primary.limiter
+
+    def _is_retryable(self, error: Exception) -> bool:
+        status = getattr(error, "status_code", None)
+        if status is not None:
+            return status == 429 or status >= 500
+        return type(error).__name__ in RETRYABLE_ERRORS
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, 0.5)
+            except ValueError:
+                pass
+        # Full jitter exponential backoff
+        return random.uniform(0, min(20.0, 0.5 * 2 ** attempt))
+
+    def _stream_once(self, provider: Provider, request: Dict, first_token: threading.Event,
+                     cancelled: threading.Event) -> str:
+        """Stream one completion, signalling ``first_token`` and stopping early if ``cancelled``"""
+        start = time.monotonic()
+        stream = provider.client.chat.completions.create(**request, stream=True)
+        parts = []
+        try:
+            for chunk in stream:
+                if cancelled.is_set():
+                    break
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    if not parts:
+                        provider.first_token_latencies.append(time.monotonic() - start)
+                        first_token.set()
+                    parts.append(delta)
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+        return "".join(parts)
+
+    def _call_provider(self, provider: Provider, request: Dict, priority: int,
+                       first_token: threading.Event, cancelled: threading.Event) -> str:
+        """One provider leg: limiter, retries and circuit breaker bookkeeping"""
+        ticket = provider.breaker.acquire()
+        if ticket is None:
+            raise CircuitOpenError(f"{provider.name} circuit breaker is open")
+        request = {**request, "model": provider.model or request["model"]}
+        estimated = estimate_tokens(request["messages"], request["max_tokens"])
+        try:
+            for attempt in range(self.max_retries + 1):
+                provider.limiter.acquire(estimated, priority)
+                if cancelled.is_set():
+                    return None
+                try:
+                    text = self._stream_once(provider, request, first_token, cancelled)
+                except Exception as e:
+                    if attempt == self.max_retries or not self._is_retryable(e) or cancelled.is_set():
+                        # Only timeouts, connection errors, 429 and 5xx say the provider is unhealthy;
+                        # a rejected request (400, 401, 404, ...) would fail on any provider
+                        if self._is_retryable(e):
+                            provider.breaker.record_failure()
+                        raise
+                    time.sleep(self._retry_delay(e, attempt))
+                    continue
+                provider.breaker.record_success()
+                provider.limiter.adjust(estimated, estimated - request["max_tokens"] + len(text) // 4)
+                # A stream stopped by cancellation is incomplete
+                return None if cancelled.is_set() else text
+        finally:
+            if ticket == "probe":
+                # No-op once the probe recorded a result
+                provider.breaker.release_probe()
+
+    def _hedge_delay(self) -> float:
+        observed = self.primary.first_token_percentile(self.hedge_percentile)
+        return max(self.hedge_min_delay, observed) if observed is not None else self.hedge_min_delay
+
+    def chat(self, messages: List[Dict], model: str, temperature: float = 0.1, max_tokens: int = 1000,
+             priority: int = Priority.INTERACTIVE, timeout: Optional[float] = None,
+             cancelled: Optional[threading.Event] = None) -> Optional[str]:
+        """Run a chat completion through the limiter with retries, returning the message text.
+
+        With a secondary provider configured, the same request is also sent to it when the
+        primary has produced no first token by the hedge deadline, and the first successful
+        answer wins. Providers whose circuit breaker is open are skipped, and
+        CircuitOpenError is raised when every breaker is open.
+
+        ``timeout`` bounds each HTTP request; setting ``cancelled`` stops the call at its
+        next chunk or retry and makes it return None.
+        """
+        request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        if timeout is not None:
+            request["timeout"] = timeout
+        available = [p for p in self.providers if p.breaker.allow()]
+        if not available:
+            raise CircuitOpenError("every LLM provider's circuit breaker is open")
+
+        if len(available) == 1:
+            return self._call_provider(available[0], request, priority, threading.Event(), _Cancellation(cancelled))
+        if not self.hedging:
+            # Plain failover in provider order
+            for index, provider in enumerate(available):
+                try:
+                    return self._call_provider(provider, request, priority, threading.Event(), _Cancellation(cancelled))
+                except Exception:
+                    if index == len(available) - 1:
+                        raise
+
+        legs_cancelled = _Cancellation(cancelled)
+        primary_first_token = threading.Event()
+        futures = {self._executor.submit(self._call_provider, available[0], request, priority,
+                                         primary_first_token, legs_cancelled): available[0]}
+        try:
+            primary_future = next(iter(futures))
+            hedge_at = time.monotonic() + self._hedge_delay()
+            # Wait for the primary's first token, its completion or failure, or the hedge deadline
+            while not primary_first_token.is_set() and not primary_future.done() and time.monotonic() < hedge_at:
+                primary_first_token.wait(timeout=min(0.05, max(0.0, hedge_at - time.monotonic())))
+
+            primary_ok = primary_first_token.is_set() or (primary_future.done() and primary_future.exception() is None)
+            if not primary_ok:
+                futures[self._executor.submit(self._call_provider, available[1], request, priority,
+                                              threading.Event(), legs_cancelled)] = available[1]
+
+            error = None
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and future.result() is not None:
+                        return future.result()
+                    error = future.exception() or error
+            if error is None:
+                # Every leg was cancelled by the caller
+                return None
+            raise error
+        finally:
+            # Stop the losing leg from streaming the rest of its answer
+            legs_cancelled.set()
+
+    def async_http_client(self, priority: int = Priority.VOICE, provider: Provider = None) -> httpx.AsyncClient:
+        """Pooled async HTTP client whose requests pass through the shared limiter.
+
+        Used to hand a rate-limited transport to SDK clients that manage their own
+        request flow (e.g. the LiveKit LLM plugins in the voice agent). Callers on the
+        same event loop share one client per provider and priority; close them with
+        aclose_async_clients() when the loop's work is done.
+        """
+        provider = provider or self.primary
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get((provider.name, priority))
+            if client is None or client.is_closed:
+                limiter = provider.limiter
+
+                async def _acquire(request: httpx.Request):
+                    if request.url.path.endswith("/chat/completions"):
+                        await asyncio.to_thread(limiter.acquire, len(request.content) // 4, priority)
+
+                client = clients[(provider.name, priority)] = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+                    timeout=httpx.Timeout(60.0, connect=5.0),
+                    event_hooks={"request": [_acquire]},
+                )
+            return client
+
+    async def aclose_async_clients(self):
+        """Close the async clients created for the running event loop"""
+        with self._async_clients_lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """Process-wide gateway instance"""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Move flat ehr_outputs/ and patient_notes/ directories into the sharded layout.
+
+    python agents/common/migrate_storage.py            # both default directories
+    python agents/common/migrate_storage.py --dry-run
+    python agents/common/migrate_storage.py path/to/patient_notes
+
+Each file is journaled first and then renamed into its shard, oldest first so
+the journal's order matches modification times. Until the rename, readers
+still find the file at its flat path, so the tool can run while the agents
+are up, and re-running it only picks up files that are still flat. EHR
+summaries move along with their EHR.
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.ehr_summary import summary_path
+from common.sharded_store import EHR_OUTPUT_METADATA, ShardedStore
+
+AGENTS_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_DIRS = [AGENTS_DIR / "ehr_agent" / "ehr_outputs", AGENTS_DIR / "medical_agent" / "patient_notes"]
+
+
+def migrate(root: Path, dry_run: bool = False) -> int:
+    store = ShardedStore(root, exclude=EHR_OUTPUT_METADATA)
+    files = sorted(store.legacy_files(), key=lambda p: p.stat().st_mtime)
+    print(f"📦 {root}: {len(files)} file(s) to move")
+
+    for path in files:
+        target = store.path_for(path.name)
+        if dry_run:
+            print(f"   {path.name} -> {target.relative_to(root)}")
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        store.record(path.name, path.stat().st_mtime)
+        if target.exists():
+            # Already written in the sharded layout; the flat copy is older
+            path.unlink()
+            continue
+        old_summary = summary_path(path)
+        os.rename(path, target)
+        if old_summary.exists():
+            new_summary = summary_path(target)
+            new_summary.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(old_summary, new_summary)
+    return len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move flat EHR and notes directories into hash-sharded subdirectories")
+    parser.add_argument("dirs", nargs="*", type=Path, default=DEFAULT_DIRS)
+    parser.add_argument("--dry-run", action="store_true", help="only show what would move")
+    args = parser.parse_args()
+
+    moved = sum(migrate(root, args.dry_run) for root in args.dirs if root.is_dir())
+    print(f"✅ {'Would move' if args.dry_run else 'Moved'} {moved} file(s)")
+
+
+if __name__ == "__main__":
+    main()
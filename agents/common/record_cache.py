@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Size-bounded record cache with an on-disk spill store.
+
+Behaves like a dict of parsed records, but only the most recently used ones
+stay in memory as Python objects, up to ``max_bytes`` of estimated size. Least
+recently used records are evicted to a SQLite file as zlib-compressed
+pickles, typically a tenth of their in-memory size, and parsed back in on the
+next access. Keys and their order are always kept in memory, so ``len``,
+``in`` and iteration never touch the disk.
+
+The spill file is scratch space for one process and is deleted on close.
+Records are copied when they spill, so changes made to a record object after
+it was evicted are lost; store the changed record again instead.
+"""
+
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+_MISSING = object()
+
+
+def estimate_size(obj: Any, _seen: Optional[set] = None) -> int:
+    """Approximate deep memory footprint of a tree of dicts, lists, slotted records and scalars"""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, _seen) + estimate_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in obj)
+    else:
+        # Objects with __slots__ (e.g. the EHR record types) keep their values in set slots
+        for cls in type(obj).__mro__:
+            slots = cls.__dict__.get("__slots__", ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                try:
+                    size += estimate_size(object.__getattribute__(obj, name), _seen)
+                except AttributeError:
+                    continue
+    return size
+
+
+class RecordCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, spill_dir: Optional[str] = None, name: str = "records"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._hot: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._keys: Dict[Hashable, None] = {}
+        self._hot_bytes = 0
+        self._lock = threading.RLock()
+        fd, self.spill_path = tempfile.mkstemp(prefix=f"{name}-", suffix=".sqlite", dir=spill_dir)
+        os.close(fd)
+        self._db = sqlite3.connect(self.spill_path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE records (key BLOB PRIMARY KEY, value BLOB)")
+        self._finalizer = weakref.finalize(self, _remove_spill, self._db, self.spill_path)
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "spilled_bytes": 0}
+
+    @staticmethod
+    def _key(key: Hashable) -> bytes:
+        return pickle.dumps(key)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._hot:
+                self._hot_bytes -= self._hot.pop(key)[1]
+            elif key in self._keys:
+                self._db.execute("DELETE FROM records WHERE key = ?", (self._key(key),))
+            self._keys[key] = None
+            self._hot[key] = (value, size)
+            self._hot_bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Always keep the newest record resident, even if it alone exceeds the cap
+        while self._hot_bytes > self.max_bytes and len(self._hot) > 1:
+            key, (value, size) = self._hot.popitem(last=False)
+            self._hot_bytes -= size
+            blob = zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            self._db.execute("INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)", (self._key(key), blob))
+            self.stats["evictions"] += 1
+            self.stats["spilled_bytes"] += len(blob)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._hot.get(key)
+            if entry is not None:
+                self._hot.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            if key not in self._keys:
+                return default
+            row = self._db.execute("SELECT value FROM records WHERE key = ?", (self._key(key),)).fetchone()
+            self.stats["misses"] += 1
+            if row is None:
+                return default
+            value = pickle.loads(zlib.decompress(row[0]))
+            # Promote back into memory; the spilled copy is dropped when it is evicted again
+            self._db.execute("DELETE FROM records WHERE key = ?", (self._key(key),))
+            size = estimate_size(value)
+            self._hot[key] = (value, size)
+            self._hot_bytes += size
+            self._evict()
+            return value
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key: Hashable):
+        with self._lock:
+            if key not in self._keys:
+                raise KeyError(key)
+            del self._keys[key]
+            if key in self._hot:
+                self._hot_bytes -= self._hot.pop(key)[1]
+            else:
+                self._db.execute("DELETE FROM records WHERE key = ?", (self._key(key),))
+
+    def pop(self, key: Hashable, default: Any = _MISSING) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        del self[key]
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._keys))
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        """Every (key, record) pair; cold records are read back one at a time"""
+        for key in list(self._keys):
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                yield key, value
+
+    def values(self) -> Iterator[Any]:
+        for _, value in self.items():
+            yield value
+
+    def metrics(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "records": len(self._keys),
+                "resident": len(self._hot),
+                "resident_bytes": self._hot_bytes,
+                "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+            }
+
+    def report(self):
+        m = self.metrics()
+        print(f"🗄️  {self.name}: {m['resident']}/{m['records']} records in memory "
+              f"({m['resident_bytes'] / 1e6:.1f}/{self.max_bytes / 1e6:.0f} MB), "
+              f"{m['hits']} hits, {m['misses']} disk loads, {m['evictions']} evictions")
+
+    def close(self):
+        self._finalizer()
+
+
+def _remove_spill(db: sqlite3.Connection, path: str):
+    db.close()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Hash-sharded file storage for ehr_outputs/ and patient_notes/.
+
+Every file is stored under two levels of hash-prefixed subdirectories:
+
+    <root>/3f/a2/jane_doe.yaml        (first four hex digits of sha1(name))
+
+so no directory grows past a few hundred entries even with millions of
+files, and the path of any file follows from its name alone. Nothing lists
+directories: writers append the name to ``journal.log`` after the file is in
+place, and readers get
+
+  names()           every stored name, in journal order
+  latest()          the name with the newest recorded modification time
+  changes(offset)   names written since a previous read, for incremental scans
+
+Journal lines are single O_APPEND writes, so concurrent writers never
+interleave; a torn last line from a crash is ignored until it is completed.
+Files still in the old flat layout are found by ``resolve`` and listed once
+by ``names`` until migrate_storage.py has moved them.
+"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+JOURNAL_NAME = "journal.log"
+# Bookkeeping files that stay at the top of ehr_outputs/ rather than in shards
+EHR_OUTPUT_METADATA = ("processed_mapping.yaml",)
+
+
+def shard_of(name: str, levels: int = 2) -> Tuple[str, ...]:
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+    return tuple(digest[2 * i:2 * i + 2] for i in range(levels))
+
+
+class ShardedStore:
+    def __init__(self, root: str, suffix: str = ".yaml", exclude: Tuple[str, ...] = (), levels: int = 2):
+        self.root = Path(root)
+        self.suffix = suffix
+        self.exclude = set(exclude)
+        self.levels = levels
+        self.journal_path = self.root / JOURNAL_NAME
+        self._names: Dict[str, None] = {}
+        self._offset = 0
+        self._legacy_checked = False
+        self._latest: Optional[Tuple[float, str]] = None
+
+    def path_for(self, name: str) -> Path:
+        """Where ``name`` lives in the sharded layout (whether or not it exists yet)"""
+        return self.root.joinpath(*shard_of(name, self.levels), name)
+
+    def resolve(self, name: str) -> Path:
+        """Existing path of ``name``, falling back to the flat layout for files not yet migrated"""
+        path = self.path_for(name)
+        if not path.exists():
+            legacy = self.root / name
+            if legacy.is_file():
+                return legacy
+        return path
+
+    def exists(self, name: str) -> bool:
+        return self.resolve(name).exists()
+
+    def write_text(self, name: str, text: str, tmp_tag: str = "") -> Path:
+        """Atomically replace ``name`` with ``text`` and journal the write"""
+        path = self.path_for(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{name}.{tmp_tag or os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        legacy = self.root / name
+        if legacy.is_file():
+            # A write supersedes the unmigrated copy
+            legacy.unlink()
+        self.record(name)
+        return path
+
+    def reserve(self, name: str) -> bool:
+        """Create ``name`` empty unless it exists anywhere; True if this caller got it"""
+        if (self.root / name).is_file():
+            return False
+        path = self.path_for(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            return False
+        self.record(name)
+        return True
+
+    def record(self, name: str, mtime: Optional[float] = None):
+        """Journal a write of ``name``; called after the file is in place"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        line = (json.dumps({"name": name, "mtime": mtime if mtime is not None else time.time()}) + "\n").encode("utf-8")
+        fd = os.open(self.journal_path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _read(self, offset: int) -> Tuple[List[Tuple[str, float]], int]:
+        """(name, mtime) entries journaled after byte ``offset`` and the new offset"""
+        entries = []
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        entry = json.loads(line)
+                        entries.append((entry["name"], float(entry.get("mtime") or 0)))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries, offset
+
+    def changes(self, offset: int = 0) -> Tuple[List[str], int]:
+        """Names journaled after byte ``offset`` (each once, last write order) and the new offset"""
+        entries, offset = self._read(offset)
+        names: Dict[str, None] = {}
+        for name, _ in entries:
+            names.pop(name, None)
+            names[name] = None
+        return list(names), offset
+
+    def names(self) -> List[str]:
+        """Every stored name in journal order; only new journal lines are read"""
+        if not self._legacy_checked:
+            # One listing of the top level per store; once migrated it holds only shard directories
+            self._legacy_checked = True
+            legacy = self.legacy_files()
+            if legacy:
+                print(f"⚠️  {len(legacy)} file(s) in {self.root} are not in the sharded layout yet; "
+                      f"run agents/common/migrate_storage.py")
+                for path in sorted(legacy, key=lambda p: p.stat().st_mtime):
+                    self._add(path.name, path.stat().st_mtime)
+        entries, self._offset = self._read(self._offset)
+        for name, mtime in entries:
+            self._add(name, mtime)
+        return list(self._names)
+
+    def _add(self, name: str, mtime: float):
+        self._names.pop(name, None)
+        self._names[name] = None
+        # Migrated files are journaled after newer writes, so order alone does not give the latest
+        if self._latest is None or mtime >= self._latest[0]:
+            self._latest = (mtime, name)
+
+    def latest(self) -> Optional[str]:
+        """The name with the newest recorded modification time"""
+        self.names()
+        return self._latest[1] if self._latest else None
+
+    def legacy_files(self) -> List[Path]:
+        """Data files still at the top level in the flat layout"""
+        if not self.root.is_dir():
+            return []
+        return [p for p in self.root.iterdir()
+                if p.is_file() and p.name.endswith(self.suffix) and not p.name.startswith(".") and p.name not in self.exclude]
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical concurrent requests.
+
+The first caller for a key runs the work; callers arriving with the same key
+while it is in flight await the same future instead of repeating it. The key
+is forgotten as soon as the work finishes, so this never serves stale results:
+it only collapses bursts, and anything later starts a fresh call.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    async def do(self, key: Hashable, work: Callable[[], Awaitable[Any]]) -> Any:
+        """Result of ``work()``, shared with every concurrent caller using ``key``"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            # Shield so one waiter being cancelled does not cancel the shared call
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.stats["calls"] += 1
+        try:
+            result = await work()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved so an unawaited failure is not logged as never retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._inflight
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Offline semantic retrieval over EHR records.
+
+Embeddings are computed locally with no model download or network call:
+text is normalized, clinical synonyms are folded onto one canonical term
+("shortness of breath", "sob" and "breathlessness" all become "dyspnea"),
+and word unigrams, word bigrams and character trigrams are hashed into a
+fixed-size signed vector that is L2-normalized.
+
+Vectors live in a float32 matrix memory-mapped from ``vectors.f32``; row ids
+and content versions are kept in an append-only ``rows.log`` that is replayed
+on open. Upserting a record whose version is unchanged is a no-op, so callers
+can re-index everything they load and only changed records are re-embedded.
+Search is one matrix-vector product plus ``argpartition`` for the top k; at
+the default 256 dimensions one million records take 1 GB on disk and a scan
+takes tens of milliseconds with a multi-threaded BLAS once the file is in the
+page cache (about 90 ms on a single core; 128 dimensions roughly halves it).
+
+One process should own (write) an index directory; readers call ``reload()``
+to pick up rows appended by the writer. ``VectorIndex.open_shared`` settles
+this between processes with an flock held for the writer's lifetime; the
+others open the index read-only and can ``promote()`` once the writer exits.
+"""
+
+import fcntl
+import hashlib
+import json
+import re
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_DIM = 256
+INITIAL_CAPACITY = 1024
+
+# Lay terms and abbreviations folded onto one canonical clinical term
+MEDICAL_SYNONYMS = {
+    "dyspnea": ["shortness of breath", "short of breath", "difficulty breathing", "trouble breathing",
+                "breathlessness", "breathless", "can't breathe", "cannot breathe", "sob", "dyspnoea"],
+    "chest_pain": ["chest pain", "chest tightness", "chest pressure", "angina"],
+    "myocardial_infarction": ["heart attack", "mi", "myocardial infarction"],
+    "hypertension": ["high blood pressure", "hypertension", "htn", "elevated blood pressure"],
+    "hypotension": ["low blood pressure", "hypotension"],
+    "tachycardia": ["racing heart", "fast heart rate", "rapid heartbeat", "tachycardia", "palpitations"],
+    "pyrexia": ["fever", "febrile", "high temperature", "pyrexia"],
+    "cephalgia": ["headache", "head ache", "migraine", "cephalgia"],
+    "syncope": ["fainting", "fainted", "passed out", "loss of consciousness", "syncope"],
+    "emesis": ["vomiting", "vomit", "throwing up", "threw up", "emesis"],
+    "nausea": ["nausea", "nauseous", "queasy", "feeling sick"],
+    "vertigo": ["dizziness", "dizzy", "lightheaded", "light headed", "vertigo"],
+    "fatigue": ["tiredness", "tired", "exhausted", "exhaustion", "lethargy", "fatigue"],
+    "diabetes": ["diabetes", "diabetic", "high blood sugar", "hyperglycemia", "dm"],
+    "fracture": ["broken", "break", "fracture", "fractured", "cracked bone"],
+    "abdominal_pain": ["stomach ache", "stomach pain", "belly pain", "tummy ache", "abdominal pain"],
+    "cough": ["coughing", "cough"],
+    "rash": ["rash", "hives", "skin irritation", "urticaria"],
+    "stroke": ["stroke", "cva", "facial droop", "slurred speech"],
+    "seizure": ["seizure", "seizures", "convulsion", "convulsions", "fit"],
+}
+
+_SYNONYM_PATTERNS = sorted(
+    ((phrase, canonical) for canonical, phrases in MEDICAL_SYNONYMS.items() for phrase in phrases),
+    key=lambda item: -len(item[0]),
+)
+_SYNONYM_RE = re.compile(r"\b(" + "|".join(re.escape(phrase) for phrase, _ in _SYNONYM_PATTERNS) + r")\b")
+_SYNONYM_LOOKUP = dict(_SYNONYM_PATTERNS)
+
+
+def normalize_text(text: str) -> str:
+    text = text.lower().replace("’", "'")
+    text = _SYNONYM_RE.sub(lambda m: f" {_SYNONYM_LOOKUP[m.group(1)]} ", text)
+    return " ".join(re.sub(r"[^\w']+", " ", text).split())
+
+
+def _hash_feature(feature: str, dim: int) -> Tuple[int, float]:
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    value = int.from_bytes(digest, "little")
+    return value % dim, 1.0 if (value >> 63) & 1 else -1.0
+
+
+def embed(text: str, dim: int = DEFAULT_DIM) -> np.ndarray:
+    """Hashed n-gram embedding, L2-normalized (all zeros for empty text)"""
+    vector = np.zeros(dim, dtype=np.float32)
+    words = normalize_text(text).split()
+    features = [(w, 1.0) for w in words]
+    features += [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f"<{word}>"
+        features += [(f"#{padded[i:i + 3]}", 0.25) for i in range(len(padded) - 2)]
+
+    for feature, weight in features:
+        index, sign = _hash_feature(feature, dim)
+        vector[index] += sign * weight
+
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def record_text(record: Any) -> str:
+    """Flatten the values of an EHR record into one string for embedding"""
+    parts: List[str] = []
+
+    def walk(value):
+        if isinstance(value, Mapping):
+            for item in value.values():
+                walk(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                walk(item)
+        elif value not in (None, ""):
+            parts.append(str(value))
+
+    walk(record)
+    return " ".join(parts)
+
+
+class VectorIndex:
+    def __init__(self, index_dir: str, dim: int = DEFAULT_DIM, writable: bool = True):
+        self.index_dir = Path(index_dir)
+        self.dim = dim
+        self.writable = writable
+        self.vectors_path = self.index_dir / "vectors.f32"
+        self.rows_path = self.index_dir / "rows.log"
+        self._lock = threading.Lock()
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.versions: Dict[str, str] = {}
+        self._log_offset = 0
+        self._matrix: Optional[np.memmap] = None
+        self._writer_lock = None
+
+        if writable:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            self._check_dim()
+        self.reload()
+
+    @classmethod
+    def open_shared(cls, index_dir: str, dim: int = DEFAULT_DIM) -> "VectorIndex":
+        """Open an index several processes use: whoever takes the writer lock writes, the rest only read"""
+        lock = _take_writer_lock(Path(index_dir))
+        index = cls(index_dir, dim, writable=lock is not None)
+        index._writer_lock = lock
+        return index
+
+    def promote(self) -> bool:
+        """Take over writing if the writer has exited; True if this index is writable"""
+        if self.writable:
+            return True
+        lock = _take_writer_lock(self.index_dir)
+        if lock is None:
+            return False
+        self._writer_lock = lock
+        self.writable = True
+        self._check_dim()
+        with self._lock:
+            # Remap read-write
+            self._matrix = None
+        self.reload()
+        return True
+
+    def _check_dim(self):
+        meta_path = self.index_dir / "meta.json"
+        if meta_path.exists():
+            stored = json.loads(meta_path.read_text()).get("dim")
+            if stored != self.dim:
+                raise ValueError(f"Vector index at {self.index_dir} has dim {stored}, expected {self.dim}")
+        else:
+            meta_path.write_text(json.dumps({"dim": self.dim}))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def reload(self):
+        """Replay rows appended to the log since the last call and remap the matrix"""
+        with self._lock:
+            if self.rows_path.exists():
+                with open(self.rows_path, "r") as f:
+                    f.seek(self._log_offset)
+                    for line in f:
+                        if not line.endswith("\n"):
+                            # Partially written entry; pick it up next time
+                            break
+                        self._log_offset += len(line.encode("utf-8"))
+                        self._apply_log_entry(json.loads(line))
+            self._map(len(self.ids))
+
+    def _apply_log_entry(self, entry: Dict):
+        row, record_id = entry["row"], entry["id"]
+        while len(self.ids) <= row:
+            self.ids.append(None)
+        if entry.get("deleted"):
+            self.ids[row] = None
+            self.rows.pop(record_id, None)
+            self.versions.pop(record_id, None)
+        else:
+            self.ids[row] = record_id
+            self.rows[record_id] = row
+            self.versions[record_id] = entry.get("version")
+
+    def _map(self, min_rows: int):
+        if not self.vectors_path.exists() and not self.writable:
+            self._matrix = None
+            return
+        capacity = self._matrix.shape[0] if self._matrix is not None else 0
+        file_rows = self.vectors_path.stat().st_size // (4 * self.dim) if self.vectors_path.exists() else 0
+        if self.writable and file_rows < min_rows:
+            # Grow geometrically so appends stay amortized O(1)
+            new_rows = max(INITIAL_CAPACITY, file_rows * 2, min_rows)
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(new_rows * 4 * self.dim)
+            file_rows = new_rows
+        if file_rows and file_rows != capacity:
+            if self._matrix is not None and self.writable:
+                self._matrix.flush()
+            mode = "r+" if self.writable else "r"
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode=mode, shape=(file_rows, self.dim))
+
+    def upsert(self, record_id: str, text: str, version: Optional[str] = None) -> bool:
+        """Embed and store a record; returns False when the stored version is already current"""
+        if not self.writable:
+            raise PermissionError("Vector index opened read-only")
+        version = version or hashlib.sha1(text.encode("utf-8")).hexdigest()
+        if self.versions.get(record_id) == version:
+            return False
+        vector = embed(text, self.dim)
+
+        with self._lock:
+            row = self.rows.get(record_id)
+            if row is None:
+                row = len(self.ids)
+                self._map(row + 1)
+            self._matrix[row] = vector
+            self._append_log({"row": row, "id": record_id, "version": version})
+        return True
+
+    def upsert_many(self, records: Iterable[Tuple[str, str, Optional[str]]]) -> int:
+        """Upsert (record_id, text, version) tuples and flush once; returns how many changed"""
+        changed = sum(self.upsert(record_id, text, version) for record_id, text, version in records)
+        if changed:
+            self.flush()
+        return changed
+
+    def remove(self, record_id: str):
+        with self._lock:
+            row = self.rows.get(record_id)
+            if row is None:
+                return
+            self._matrix[row] = 0.0
+            self._append_log({"row": row, "id": record_id, "deleted": True})
+
+    def _append_log(self, entry: Dict):
+        line = json.dumps(entry) + "\n"
+        with open(self.rows_path, "a") as f:
+            f.write(line)
+        self._log_offset += len(line.encode("utf-8"))
+        self._apply_log_entry(entry)
+
+    def flush(self):
+        with self._lock:
+            if self._matrix is not None and self.writable:
+                self._matrix.flush()
+
+    def search(self, query: str, k: int = 5, min_score: float = 0.0,
+               candidates: Optional[Iterable[str]] = None) -> List[Tuple[str, float]]:
+        """Cosine top-k as (record_id, score), best first; optionally restricted to ``candidates``"""
+        query_vector = embed(query, self.dim)
+        if not query_vector.any() or self._matrix is None or not self.rows:
+            return []
+
+        with self._lock:
+            count = len(self.ids)
+            if candidates is not None:
+                rows = np.fromiter((self.rows[c] for c in candidates if c in self.rows), dtype=np.int64)
+                if not rows.size:
+                    return []
+                scores = self._matrix[rows] @ query_vector
+            else:
+                rows = None
+                # Vectors are unit length, so the dot product is the cosine similarity
+                scores = self._matrix[:count] @ query_vector
+
+            k = min(k, scores.shape[0])
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            results = []
+            for i in top:
+                row = int(rows[i]) if rows is not None else int(i)
+                record_id = self.ids[row]
+                if record_id is not None and scores[i] > min_score:
+                    results.append((record_id, float(scores[i])))
+            return results
+
+
+def _take_writer_lock(index_dir: Path):
+    """Open file holding the directory's exclusive writer lock, or None if another process has it"""
+    index_dir.mkdir(parents=True, exist_ok=True)
+    lock_file = open(index_dir / "writer.lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
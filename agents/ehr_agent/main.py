@@ -5,11 +5,28 @@ import json
 import os
 import yaml
 from datetime import datetime
-from groq import Groq
 import requests
 from pathlib import Path
 import random
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.coral_client import CoralClient
+from common.ehr_models import EHRRecord
+from common.ehr_summary import write_summary
+from common.handoff_queue import HandoffQueue
+from common.leases import LeaseManager, default_worker_id
+from common.ledger import Ledger
+from common.llm_gateway import Priority, get_gateway
+from common.record_cache import RecordCache
+from common.sharded_store import EHR_OUTPUT_METADATA, ShardedStore
+from common.single_flight import SingleFlight
+from common.vector_index import VectorIndex, record_text
+
+from note_queue import NoteQueue, score_note
 
 class EHRAgent:
     def __init__(self):
@@ -18,18 +35,76 @@ class EHRAgent:
         self.api_key = os.getenv("API_KEY")
         self.coral_sse_url = os.getenv("CORAL_SSE_URL", "http://localhost:5555")
         self.agent_id = os.getenv("CORAL_AGENT_ID", "ehr_agent")
+        # Set by Coral when it launches the agent; otherwise join the local devmode session
+        self.coral_connection_url = os.getenv(
+            "CORAL_CONNECTION_URL",
+            f"{self.coral_sse_url.rstrip('/')}/sse/v1/devmode/exampleApplication/privkey/session1/sse?agentId={self.agent_id}",
+        )
+        self.coral = None
         self.output_dir = Path(os.getenv("OUTPUT_DIR", "./ehr_outputs"))
         self.patient_notes_dir = Path("../medical_agent/patient_notes/")
+        self.handoff_queue = HandoffQueue(
+            os.getenv("HANDOFF_QUEUE_DIR", "../medical_agent/handoff_queue"),
+            # Failed handoffs are retried after 30s, 60s, 120s, ... up to the cap
+            retry_base_s=float(os.getenv("EHR_HANDOFF_RETRY_S", "30")),
+            retry_max_s=float(os.getenv("EHR_HANDOFF_RETRY_MAX_S", "900")),
+        )
+        # Full directory rescans are only a safety net once the handoff queue delivers sessions directly
+        self.rescan_interval = int(os.getenv("NOTES_RESCAN_INTERVAL", "300"))
+        # Send only new sessions plus the previous EHR when a patient's notes grow
+        self.incremental_updates = os.getenv("EHR_INCREMENTAL", "true").lower() == "true"
+        # Oversized notes files are split by session into chunks of roughly this many tokens
+        self.chunk_token_budget = int(os.getenv("EHR_CHUNK_TOKENS", "3000"))
+        self.max_parallel_chunks = int(os.getenv("EHR_MAX_PARALLEL_CHUNKS", "4"))
+        # Build EHRs from structured session fields and only call the LLM for free-text notes
+        self.rules_first = os.getenv("EHR_RULES_FIRST", "true").lower() == "true"
         
         # Create output directory
         self.output_dir.mkdir(exist_ok=True)
+        # Both directories are hash-sharded and journaled, so nothing lists them in full
+        self.ehr_store = ShardedStore(self.output_dir, exclude=EHR_OUTPUT_METADATA)
+        self.notes_store = ShardedStore(self.patient_notes_dir)
+        
+        # Several workers may share the notes and output directories; each notes file is claimed with a lease
+        self.worker_id = os.getenv("EHR_WORKER_ID") or default_worker_id()
+        self.lease_ttl = float(os.getenv("EHR_LEASE_TTL_S", "900"))
+        self.leases = LeaseManager(os.getenv("EHR_LEASE_DIR", str(self.output_dir / ".leases")), self.worker_id, self.lease_ttl)
+        # Notes skipped because another worker held them; retried on the next rescan
+        self.deferred_notes = set()
+        # Pending notes are served most urgent first, with aging so routine ones are not starved
+        self.note_queue = NoteQueue(
+            aging_seconds=float(os.getenv("EHR_PRIORITY_AGING_S", "120")),
+            metrics_file=os.getenv("EHR_QUEUE_METRICS_FILE", "logs/ehr_queue_metrics.prom"),
+        )
+        
+        # Which notes files have been turned into EHRs: snapshot + append-only log, shared by all workers
+        self.processed_ledger = Ledger(
+            self.output_dir / "processed_ledger.jsonl",
+            self.output_dir / "processed_mapping.yaml",
+            compact_every=int(os.getenv("EHR_LEDGER_COMPACT_EVERY", "500")),
+        )
         
-        # Initialize Groq client
-        if self.llm_provider == "groq":
-            self.client = Groq(api_key=self.api_key)
+        # Shared, rate-limited LLM client (EHR generation runs at background priority)
+        self.gateway = get_gateway()
         
-        # Store processed EHR data for answering questions
-        self.ehr_database = {}
+        # Store processed EHR data for answering questions; cold records spill to disk.
+        # ehr_database and resident_ehrs hold the same record objects, so they split one
+        # budget: a record resident in both is counted twice but stays within the total.
+        record_cache_bytes = int(float(os.getenv("EHR_RECORD_CACHE_MB", "64")) * 1024 * 1024) // 2
+        self.ehr_database = RecordCache(record_cache_bytes, spill_dir=os.getenv("RECORD_CACHE_DIR"), name="ehr_database")
+        # Bumped on every stored EHR so coalesced answers never span a database change
+        self.database_version = 0
+        # Identical medical queries arriving together share one search and LLM call
+        self.query_flights = SingleFlight()
+        # Parsed EHR outputs by filename, so rescans never re-parse them (cold ones come back from the spill file)
+        self.resident_ehrs = RecordCache(record_cache_bytes, spill_dir=os.getenv("RECORD_CACHE_DIR"), name="resident_ehrs")
+        # Workers share one index directory; only the one holding its writer lock embeds records
+        self.vector_index = VectorIndex.open_shared(
+            os.getenv("EHR_VECTOR_INDEX_DIR", "vector_index"),
+            dim=int(os.getenv("VECTOR_INDEX_DIM", "256")),
+        )
+        self.search_top_k = int(os.getenv("EHR_SEARCH_TOP_K", "5"))
+        self.search_min_score = float(os.getenv("EHR_SEARCH_MIN_SCORE", "0.1"))
         
         # System prompt for medical EHR processing
         self.system_prompt = """You are a professional Electronic Health Records (EHR) Assistant. 
@@ -82,14 +157,10 @@ Respond with ONLY the YAML content, no other text."""
 
     def get_next_sequential_filename(self) -> str:
         """Get the next sequential filename (001.yaml, 002.yaml, etc.)"""
-        existing_files = list(self.output_dir.glob("*.yaml"))
-        if not existing_files:
-            return "001.yaml"
-        
         # Extract numbers from existing files
         numbers = []
-        for file in existing_files:
-            match = re.match(r'^(\d+)\.yaml$', file.name)
+        for name in self.ehr_store.names():
+            match = re.match(r'^(\d+)\.yaml$', name)
             if match:
                 numbers.append(int(match.group(1)))
         
@@ -97,76 +168,194 @@ Respond with ONLY the YAML content, no other text."""
             next_num = max(numbers) + 1
         else:
             next_num = 1
-            
-        return f"{next_num:03d}.yaml"
+        
+        # Reserve the name with O_EXCL so concurrent workers never get the same number
+        while True:
+            filename = f"{next_num:03d}.yaml"
+            if self.ehr_store.reserve(filename):
+                return filename
+            next_num += 1
 
-    def load_patient_notes(self) -> list:
-        """Load all patient notes from medical agent directory"""
+    def load_patient_notes(self, processed_mapping: dict = None) -> list:
+        """Load the patient notes that need work; files the mapping shows as up to date are only stat'ed"""
         patient_files = []
         if not self.patient_notes_dir.exists():
             print(f"⚠️  Patient notes directory not found: {self.patient_notes_dir}")
             return patient_files
-            
-        for yaml_file in self.patient_notes_dir.glob("*.yaml"):
+        
+        # Phase 1: compare stat metadata against the mapping without parsing anything
+        up_to_date = 0
+        for name in self.notes_store.names():
+            yaml_file = self.notes_store.resolve(name)
+            entry = (processed_mapping or {}).get(yaml_file.name)
             try:
-                with open(yaml_file, 'r') as f:
-                    patient_data = yaml.safe_load(f)
-                    patient_files.append({
-                        'filename': yaml_file.name,
-                        'filepath': str(yaml_file),
-                        'data': patient_data,
-                        'last_modified': yaml_file.stat().st_mtime
-                    })
-            except Exception as e:
-                print(f"❌ Error loading {yaml_file}: {e}")
+                if entry and self.is_up_to_date(yaml_file.stat(), entry):
+                    self.ensure_ehr_resident(entry)
+                    self.deferred_notes.discard(yaml_file.name)
+                    up_to_date += 1
+                    continue
+            except OSError:
+                continue
+            
+            # Phase 2: parse only new or changed files
+            patient_file = self.load_patient_note_file(yaml_file)
+            if patient_file:
+                patient_files.append(patient_file)
                 
-        print(f"📋 Loaded {len(patient_files)} patient note files")
+        print(f"📋 Loaded {len(patient_files)} patient note files ({up_to_date} already up to date)")
         return patient_files
 
+    def is_up_to_date(self, source_stat: os.stat_result, entry: dict) -> bool:
+        """Whether a notes file is unchanged since its EHR was generated, from stat metadata alone"""
+        if 'source_mtime' in entry:
+            if entry['source_mtime'] != source_stat.st_mtime or entry.get('source_size') != source_stat.st_size:
+                return False
+            return entry['ehr_file'] in self.resident_ehrs or self.ehr_store.exists(entry['ehr_file'])
+        # Entries written before source stats were recorded: fall back to comparing mtimes
+        try:
+            return source_stat.st_mtime <= self.ehr_store.resolve(entry['ehr_file']).stat().st_mtime
+        except OSError:
+            return False
+
+    def ensure_ehr_resident(self, entry: dict):
+        """Load an existing EHR output into memory once; later rescans reuse it"""
+        if entry['ehr_file'] in self.resident_ehrs:
+            return
+        try:
+            with open(self.ehr_store.resolve(entry['ehr_file']), 'r') as f:
+                ehr_data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            # Remember the failure so rescans do not keep re-parsing a broken file
+            print(f"❌ Error loading EHR {entry['ehr_file']}: {e}")
+            self.resident_ehrs[entry['ehr_file']] = None
+            return
+        self.resident_ehrs[entry['ehr_file']] = self.store_ehr(entry['patient_id'], ehr_data)
+
+    def load_patient_note_file(self, yaml_file: Path) -> dict:
+        """Load a single patient notes file"""
+        try:
+            with open(yaml_file, 'r') as f:
+                patient_data = yaml.safe_load(f)
+                source_stat = os.fstat(f.fileno())
+                return {
+                    'filename': yaml_file.name,
+                    'filepath': str(yaml_file),
+                    'data': patient_data,
+                    'last_modified': source_stat.st_mtime,
+                    'size': source_stat.st_size
+                }
+        except Exception as e:
+            print(f"❌ Error loading {yaml_file}: {e}")
+            return None
+
     def get_processed_files_mapping(self) -> dict:
-        """Get mapping of source files to processed EHR files"""
-        mapping_file = self.output_dir / "processed_mapping.yaml"
-        if mapping_file.exists():
-            try:
-                with open(mapping_file, 'r') as f:
-                    return yaml.safe_load(f) or {}
-            except:
-                return {}
-        return {}
-
-    def save_processed_files_mapping(self, mapping: dict):
-        """Save mapping of source files to processed EHR files"""
-        mapping_file = self.output_dir / "processed_mapping.yaml"
+        """Get mapping of source files to processed EHR files (kept in memory by the ledger)"""
+        return self.processed_ledger.entries
+
+    def save_processed_file_entry(self, source_filename: str, entry: dict):
+        """Durably record that a notes file has been processed (one fsync'd append)"""
         try:
-            with open(mapping_file, 'w') as f:
-                yaml.dump(mapping, f, default_flow_style=False)
+            self.processed_ledger.commit(source_filename, entry)
         except Exception as e:
             print(f"❌ Error saving mapping: {e}")
 
     def process_patient_notes(self):
         """Process all patient notes and create comprehensive EHR files"""
-        patient_files = self.load_patient_notes()
+        self.processed_ledger.refresh()
+        processed_mapping = self.get_processed_files_mapping()
+        for patient_file in self.load_patient_notes(processed_mapping):
+            self.enqueue_note(patient_file, processed_mapping)
+        self.process_note_queue()
+
+    def enqueue_note(self, patient_file: dict, processed_mapping: dict, message_path: Path = None):
+        """Queue a loaded notes file by urgency; ``message_path`` is the handoff to ack once done"""
+        entry = processed_mapping.get(patient_file['filename']) or {}
+        score, priority = score_note(patient_file['data'], patient_file['last_modified'], entry.get('sessions_processed') or 0)
+        if priority != "routine":
+            print(f"🚨 {patient_file['filename']} queued as {priority} (score {score})")
+        self.note_queue.push((patient_file, message_path), score, priority)
+
+    def process_note_queue(self):
+        """Process queued notes most urgent first, admitting new handoffs between files"""
+        if not self.note_queue:
+            return
         processed_mapping = self.get_processed_files_mapping()
+        while self.note_queue:
+            (patient_file, message_path), priority, waited = self.note_queue.pop()
+            ok = self.process_patient_file(patient_file, processed_mapping)
+            if message_path is not None:
+                if ok:
+                    self.handoff_queue.ack(message_path)
+                else:
+                    # Held back until its backoff expires, so the claim below cannot take it straight back
+                    delay = self.handoff_queue.nack(message_path)
+                    print(f"🔁 Retrying handoff for {patient_file['filename']} in {delay:.0f}s")
+            # An escalation saved meanwhile should not wait behind the rest of the backlog
+            self.claim_handoffs()
+        self.note_queue.report()
+
+    def process_patient_file(self, patient_file: dict, processed_mapping: dict) -> bool:
+        """Create or refresh the EHR for one patient notes file, returning False on failure"""
+        source_filename = patient_file['filename']
+        if not self.leases.try_acquire(source_filename):
+            print(f"⏭️  {source_filename} is being processed by another worker")
+            self.deferred_notes.add(source_filename)
+            return False
         
-        for patient_file in patient_files:
-            try:
-                source_filename = patient_file['filename']
-                
-                # Check if we already processed this file (based on modification time)
-                if source_filename in processed_mapping:
-                    ehr_filename = processed_mapping[source_filename]['ehr_file']
-                    ehr_file = self.output_dir / ehr_filename
-                    
-                    if ehr_file.exists():
-                        ehr_mod_time = ehr_file.stat().st_mtime
-                        if patient_file['last_modified'] <= ehr_mod_time:
-                            print(f"✅ {source_filename} already processed and up to date")
-                            # Load existing EHR into database
-                            with open(ehr_file, 'r') as f:
-                                patient_id = processed_mapping[source_filename]['patient_id']
-                                self.ehr_database[patient_id] = yaml.safe_load(f)
-                            continue
+        try:
+            self.deferred_notes.discard(source_filename)
+            # Another worker may have finished this file just before we took the lease
+            self.processed_ledger.refresh()
+            return self.generate_patient_ehr(patient_file, processed_mapping)
+        finally:
+            self.leases.release(source_filename)
+
+    def generate_patient_ehr(self, patient_file: dict, processed_mapping: dict) -> bool:
+        """Generate the EHR for a notes file this worker holds the lease on"""
+        try:
+            source_filename = patient_file['filename']
+            
+            # Check if we already processed this file (based on modification time)
+            entry = processed_mapping.get(source_filename)
+            if entry and self.is_up_to_date(os.stat(patient_file['filepath']), entry):
+                print(f"✅ {source_filename} already processed and up to date")
+                self.ensure_ehr_resident(entry)
+                return True
+            
+            sessions = (patient_file['data'] or {}).get('sessions') or []
+            previous_ehr = self.get_incremental_base(processed_mapping.get(source_filename), sessions)
+            if previous_ehr is not None:
+                new_sessions = sessions[processed_mapping[source_filename]['sessions_processed']:]
+            
+            rule_ehr = None
+            if self.rules_first:
+                rule_ehr = self.extract_with_rules(patient_file['data'], new_sessions if previous_ehr is not None else sessions)
+            
+            if rule_ehr is not None:
+                print(f"📐 Built EHR for {source_filename} from administrative session fields (no LLM call)")
+                if previous_ehr is not None:
+                    rule_ehr = self.merge_ehr(previous_ehr, rule_ehr)
+                comprehensive_ehr = yaml.dump(rule_ehr, default_flow_style=False, sort_keys=False)
+            elif previous_ehr is not None:
+                print(f"🧩 Updating EHR for {source_filename} with {len(new_sessions)} new session(s)")
                 
+                new_chunks = self.chunk_sessions(new_sessions)
+                if len(new_chunks) > 1:
+                    # Too many new sessions for one request: extract them chunk-wise and fold into the previous record
+                    update = self.process_sessions_chunked(patient_file['data'], new_chunks)
+                    comprehensive_ehr = yaml.dump(self.merge_ehr(previous_ehr, update), default_flow_style=False, sort_keys=False) if update else None
+                else:
+                    # Only the new sessions and the previous record go to the LLM, then merge deterministically
+                    update_yaml = self.process_with_llm(
+                        yaml.dump({'previous_ehr': previous_ehr, 'new_sessions': new_sessions}, default_flow_style=False),
+                        instruction="Update this patient's existing EHR with the new sessions and return the complete updated EHR YAML file"
+                    )
+                    comprehensive_ehr = self.merge_ehr_yaml(previous_ehr, update_yaml) if update_yaml else None
+            elif len(chunks := self.chunk_sessions(sessions)) > 1:
+                print(f"🏥 Processing large patient notes for: {source_filename} ({len(sessions)} sessions)")
+                ehr_data = self.process_sessions_chunked(patient_file['data'], chunks)
+                comprehensive_ehr = yaml.dump(ehr_data, default_flow_style=False, sort_keys=False) if ehr_data else None
+            else:
                 print(f"🏥 Processing patient notes for: {source_filename}")
                 
                 # Convert patient data to string for LLM processing
@@ -174,79 +363,324 @@ Respond with ONLY the YAML content, no other text."""
                 
                 # Generate comprehensive EHR
                 comprehensive_ehr = self.process_with_llm(patient_data_str)
+            
+            if comprehensive_ehr:
+                # Get sequential filename
+                sequential_filename = self.get_next_sequential_filename()
                 
-                if comprehensive_ehr:
-                    # Get sequential filename
-                    sequential_filename = self.get_next_sequential_filename()
-                    
-                    # Save comprehensive EHR
-                    filepath = self.save_ehr_yaml(comprehensive_ehr, sequential_filename)
-                    
-                    if filepath:
-                        # Parse and store in database for quick access
-                        try:
-                            ehr_data = yaml.safe_load(comprehensive_ehr)
-                            patient_id = ehr_data.get('patient_info', {}).get('patient_id', sequential_filename.replace('.yaml', ''))
-                            self.ehr_database[patient_id] = ehr_data
-                            
-                            # Update processed mapping
-                            processed_mapping[source_filename] = {
-                                'ehr_file': sequential_filename,
-                                'patient_id': patient_id,
-                                'processed_at': datetime.now().isoformat()
-                            }
-                            self.save_processed_files_mapping(processed_mapping)
-                            
-                            print(f"✅ Processed and stored EHR for {source_filename} -> {sequential_filename}")
-                        except yaml.YAMLError as e:
-                            print(f"❌ Error parsing generated YAML for {source_filename}: {e}")
-                else:
-                    print(f"❌ Failed to generate EHR for {source_filename}")
-                    
-            except Exception as e:
-                print(f"❌ Error processing {patient_file['filename']}: {e}")
+                # Save comprehensive EHR
+                filepath = self.save_ehr_yaml(comprehensive_ehr, sequential_filename)
+                
+                if filepath:
+                    # Parse and store in database for quick access
+                    try:
+                        ehr_data = yaml.safe_load(comprehensive_ehr)
+                        patient_id = (ehr_data.get('patient_info') or {}).get('patient_id') or sequential_filename.replace('.yaml', '')
+                        self.resident_ehrs[sequential_filename] = self.store_ehr(patient_id, ehr_data)
+                        
+                        # Update processed mapping
+                        self.save_processed_file_entry(source_filename, {
+                            'ehr_file': sequential_filename,
+                            'patient_id': patient_id,
+                            'processed_at': datetime.now().isoformat(),
+                            'sessions_processed': len(sessions),
+                            'last_session_id': sessions[-1].get('session_id') if sessions else None,
+                            'source_mtime': patient_file['last_modified'],
+                            'source_size': patient_file.get('size')
+                        })
+                        
+                        print(f"✅ Processed and stored EHR for {source_filename} -> {sequential_filename}")
+                        return True
+                    except yaml.YAMLError as e:
+                        print(f"❌ Error parsing generated YAML for {source_filename}: {e}")
+            else:
+                print(f"❌ Failed to generate EHR for {source_filename}")
+                
+        except Exception as e:
+            print(f"❌ Error processing {patient_file['filename']}: {e}")
+        return False
+
+    # Administrative notes written by the medical agent's tools. Triage notes,
+    # escalations and free text carry clinical content and always go to the LLM.
+    ADMINISTRATIVE_NOTE_PATTERNS = {
+        'bookkeeping': re.compile(r'^(Entered|Exited) \w+$|^Transferred from \w+ to \w+'),
+        'insurance': re.compile(r'^Insurance information collected: '),
+        'appointment': re.compile(r'^Appointment requested: (?P<type>.+) on (?P<date>.+) at (?P<time>.+)$'),
+        'billing': re.compile(r'^Billing question: (?P<question>.+)$', re.DOTALL),
+    }
+
+    def extract_with_rules(self, patient_data: dict, sessions: list) -> dict:
+        """Map purely administrative sessions straight into the EHR schema.
+        
+        Returns None when any session has a complaint, symptoms, an escalation or
+        a note the rules cannot interpret, in which case the caller uses the LLM.
+        """
+        ehr = {
+            'patient_info': {'patient_id': (patient_data or {}).get('patient_id'), 'name': (patient_data or {}).get('patient_name'),
+                             'age': None, 'gender': None, 'contact': None},
+            'chief_complaint': None,
+            'symptoms': [],
+            'vitals': {'temperature': None, 'blood_pressure': None, 'heart_rate': None,
+                       'respiratory_rate': None, 'oxygen_saturation': None},
+            'medical_history': [],
+            'assessment': {'primary_diagnosis': None, 'differential_diagnoses': [], 'clinical_notes': None},
+            'recommendations': [],
+            'urgency_level': None,
+            'generated_at': datetime.now().isoformat(),
+        }
+        for session in sessions:
+            draft = session.get('draft_ehr') or {}
+            if (session.get('chief_complaint') or session.get('symptoms')
+                    or draft.get('symptoms') or draft.get('urgency_level')):
+                return None
+            for note in session.get('notes') or []:
+                content = (note.get('content') or '').strip()
+                kind = match = None
+                for pattern_kind, pattern in self.ADMINISTRATIVE_NOTE_PATTERNS.items():
+                    match = pattern.match(content)
+                    if match:
+                        kind = pattern_kind
+                        break
+                if kind is None:
+                    return None
+                if kind == 'appointment':
+                    ehr['recommendations'].append({'action': f"{match['type']} appointment requested for {match['date']} at {match['time']}",
+                                                   'priority': None, 'timeframe': match['date']})
+                elif kind == 'billing':
+                    ehr['recommendations'].append({'action': f"Billing follow-up: {match['question']}", 'priority': 'low', 'timeframe': None})
+            
+            if session.get('patient_name'):
+                ehr['patient_info']['name'] = session['patient_name']
+            if session.get('patient_id'):
+                ehr['patient_info']['patient_id'] = session['patient_id']
+            if session.get('insurance_info'):
+                ehr['patient_info']['insurance'] = session['insurance_info']
+        
+        return ehr
+
+    def get_incremental_base(self, mapping_entry: dict, sessions: list) -> dict:
+        """Return the previous EHR if only new sessions were appended since it was generated"""
+        if not self.incremental_updates or not mapping_entry:
+            return None
+        
+        processed = mapping_entry.get('sessions_processed')
+        if not processed or processed >= len(sessions):
+            return None
+        # History must be unchanged up to the last processed session
+        if sessions[processed - 1].get('session_id') != mapping_entry.get('last_session_id'):
+            return None
+        
+        previous_ehr = self.resident_ehrs.get(mapping_entry['ehr_file'])
+        if previous_ehr is None:
+            ehr_file = self.ehr_store.resolve(mapping_entry['ehr_file'])
+            try:
+                with open(ehr_file, 'r') as f:
+                    previous_ehr = yaml.safe_load(f)
+            except (OSError, yaml.YAMLError):
+                return None
+        if isinstance(previous_ehr, EHRRecord):
+            # Merging edits the tree in place, so hand out plain dicts
+            return previous_ehr.to_dict()
+        return previous_ehr if isinstance(previous_ehr, dict) else None
+
+    def merge_ehr(self, base: dict, update: dict) -> dict:
+        """Merge two EHR records: non-empty scalars from ``update`` win, lists are unioned by key"""
+        has_value = lambda v: v not in (None, '', [])
+        merged = dict(base or {})
+        update = update or {}
+        
+        list_keys = {
+            'symptoms': lambda item: (item.get('symptom') or '').strip().lower(),
+            'medical_history': lambda item: ((item.get('condition') or '').strip().lower(), str(item.get('date') or '')),
+            'recommendations': lambda item: (item.get('action') or '').strip().lower(),
+        }
+        
+        for key, value in update.items():
+            if key == 'patient_info':
+                info = dict(merged.get('patient_info') or {})
+                for field, field_value in (value or {}).items():
+                    # Keep the established patient id stable across updates
+                    if has_value(field_value) and not (field == 'patient_id' and info.get('patient_id')):
+                        info[field] = field_value
+                merged['patient_info'] = info
+            elif key in list_keys:
+                key_fn = list_keys[key]
+                items = {}
+                for item in (merged.get(key) or []) + (value or []):
+                    if not isinstance(item, dict) or not any(has_value(v) for v in item.values()):
+                        continue
+                    item_key = key_fn(item)
+                    if item_key in items:
+                        items[item_key].update({k: v for k, v in item.items() if has_value(v)})
+                    else:
+                        items[item_key] = dict(item)
+                merged[key] = list(items.values())
+            elif key in ('vitals', 'assessment') and isinstance(value, dict):
+                section = dict(merged.get(key) or {})
+                for field, field_value in value.items():
+                    if field == 'differential_diagnoses':
+                        combined = (section.get(field) or []) + (field_value or [])
+                        section[field] = list(dict.fromkeys(d for d in combined if d))
+                    elif has_value(field_value):
+                        section[field] = field_value
+                merged[key] = section
+            elif has_value(value):
+                merged[key] = value
+        
+        merged['generated_at'] = datetime.now().isoformat()
+        return merged
+
+    def merge_ehr_yaml(self, base: dict, update_yaml: str) -> str:
+        """Merge an LLM-produced EHR update into an existing record and return YAML"""
+        try:
+            update = yaml.safe_load(update_yaml)
+        except yaml.YAMLError as e:
+            print(f"❌ Error parsing EHR update: {e}")
+            return None
+        if not isinstance(update, dict):
+            return None
+        return yaml.dump(self.merge_ehr(base, update), default_flow_style=False, sort_keys=False)
+
+    def estimate_tokens(self, text: str) -> int:
+        """Rough token count (about 4 characters per token)"""
+        return len(text) // 4 + 1
+
+    def chunk_sessions(self, sessions: list) -> list:
+        """Split sessions, in order, into chunks that fit the per-request token budget"""
+        chunks = []
+        current, current_tokens = [], 0
+        for session in sessions:
+            tokens = self.estimate_tokens(yaml.dump(session, default_flow_style=False))
+            if current and current_tokens + tokens > self.chunk_token_budget:
+                chunks.append(current)
+                current, current_tokens = [], 0
+            # A single oversized session still gets a chunk of its own
+            current.append(session)
+            current_tokens += tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def process_sessions_chunked(self, patient_data: dict, chunks: list) -> dict:
+        """Extract each session chunk in parallel and reduce the partial EHRs into one record"""
+        header = {k: v for k, v in (patient_data or {}).items() if k != 'sessions'}
+        print(f"🧩 Extracting {len(chunks)} chunks with up to {self.max_parallel_chunks} in parallel")
+        
+        def extract(chunk):
+            chunk_yaml = self.process_with_llm(yaml.dump({**header, 'sessions': chunk}, default_flow_style=False))
+            try:
+                partial = yaml.safe_load(chunk_yaml) if chunk_yaml else None
+            except yaml.YAMLError as e:
+                print(f"❌ Error parsing chunk EHR: {e}")
+                return None
+            return partial if isinstance(partial, dict) else None
+        
+        with ThreadPoolExecutor(max_workers=self.max_parallel_chunks) as executor:
+            partials = list(executor.map(extract, chunks))
+        
+        if any(partial is None for partial in partials):
+            print(f"❌ {sum(p is None for p in partials)} of {len(chunks)} chunks failed to extract")
+            return None
+        
+        # Reduce in chronological order so later sessions win for scalar fields
+        return reduce(self.merge_ehr, partials, {})
+
+    def drain_handoff_queue(self):
+        """Process sessions handed off directly by the medical agent, acknowledging each once done"""
+        if self.claim_handoffs():
+            self.process_note_queue()
+
+    def claim_handoffs(self) -> int:
+        """Move pending handoffs into the note queue, returning how many were queued"""
+        claimed = self.handoff_queue.claim()
+        if not claimed:
+            return 0
+        
+        print(f"📬 Received {len(claimed)} session handoff(s) from medical agent")
+        self.processed_ledger.refresh()
+        processed_mapping = self.get_processed_files_mapping()
+        
+        queued = 0
+        for message_path, message in claimed:
+            yaml_file = self.notes_store.resolve(message.get('source_file', ''))
+            if not message.get('source_file') or not yaml_file.is_file():
+                print(f"⚠️  Handoff for missing notes file: {yaml_file}")
+                self.handoff_queue.ack(message_path)
+                continue
+            
+            patient_file = self.load_patient_note_file(yaml_file)
+            if patient_file:
+                self.enqueue_note(patient_file, processed_mapping, message_path)
+                queued += 1
+            else:
+                # Retried after a backoff
+                self.handoff_queue.nack(message_path)
+        return queued
 
     def watch_for_new_notes(self):
         """Check for new or updated patient notes"""
-        if not hasattr(self, '_last_check_time'):
-            self._last_check_time = datetime.now().timestamp()
-            
-        current_time = datetime.now().timestamp()
-        new_files = []
+        # Only the notes journal written since the last check is read
+        new_files, self._notes_offset = self.notes_store.changes(getattr(self, '_notes_offset', 0))
         
-        if self.patient_notes_dir.exists():
-            for yaml_file in self.patient_notes_dir.glob("*.yaml"):
-                if yaml_file.stat().st_mtime > self._last_check_time:
-                    new_files.append(yaml_file)
-                    
-        if new_files:
-            print(f"🔥 Found {len(new_files)} new/updated patient notes")
+        if new_files or self.deferred_notes:
+            print(f"🔥 Found {len(new_files)} new/updated patient notes ({len(self.deferred_notes)} deferred)")
             self.process_patient_notes()
-            
-        self._last_check_time = current_time
+
+    def store_ehr(self, patient_id: str, ehr_data: dict) -> EHRRecord:
+        """Keep an EHR in memory as a compact record and in the vector index (unchanged records are not re-embedded)"""
+        record = EHRRecord.from_dict(ehr_data)
+        self.ehr_database[patient_id] = record
+        self.database_version += 1
+        if not self.vector_index.promote():
+            # The writer indexes this record when its next rescan makes it resident
+            return record
+        try:
+            self.vector_index.upsert_many([(patient_id, record_text(ehr_data), None)])
+        except Exception as e:
+            print(f"⚠️  Could not index EHR for {patient_id}: {e}")
+        return record
 
     def search_ehr_database(self, query: str) -> dict:
-        """Search through EHR database for relevant information"""
+        """Find the EHRs most similar to the query (cosine top-k over local embeddings)"""
         results = {}
-        query_lower = query.lower()
-        
-        for patient_id, ehr_data in self.ehr_database.items():
-            # Search through EHR data for relevant information
-            matches = []
-            ehr_str = yaml.dump(ehr_data, default_flow_style=False).lower()
-            
-            if any(term in ehr_str for term in query_lower.split()):
-                results[patient_id] = ehr_data
+        if not self.vector_index.writable:
+            # Pick up rows the writer added since the last search
+            self.vector_index.reload()
+        for patient_id, _ in self.vector_index.search(query, k=self.search_top_k, min_score=self.search_min_score):
+            if patient_id in self.ehr_database:
+                results[patient_id] = self.ehr_database[patient_id]
                 
         return results
 
     async def connect_to_coral(self):
-        """Connect to Coral server via SSE"""
-        print(f"🌊 Connecting EHR Agent to Coral Server at {self.coral_sse_url}")
-        # In a real implementation, this would establish SSE connection
-        # For now, we'll simulate the connection
+        """Keep a Coral session open in the background and hand incoming mentions to a worker pool"""
+        print(f"🌊 Connecting EHR Agent to Coral Server at {self.coral_connection_url}")
+        self.coral = CoralClient(
+            self.coral_connection_url,
+            self.agent_id,
+            self.handle_coral_message,
+            workers=int(os.getenv("CORAL_WORKERS", "8")),
+            max_pending=int(os.getenv("CORAL_MAX_PENDING", "32")),
+            wait_timeout_ms=int(os.getenv("CORAL_WAIT_TIMEOUT_MS", "30000")),
+            batch_window_s=float(os.getenv("CORAL_SEND_BATCH_MS", "50")) / 1000,
+        )
+        self.coral_task = asyncio.create_task(self.coral.run())
         return True
 
+    async def handle_coral_message(self, coral_message: dict):
+        """Unwrap a Coral thread message into the agent message format"""
+        content = coral_message.get("content") or ""
+        try:
+            message = json.loads(content)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict) or "type" not in message:
+            # Plain text mentions are questions
+            message = {"type": "medical_query", "content": content}
+        message["sender"] = coral_message.get("senderId")
+        message["thread_id"] = coral_message.get("threadId")
+        await self.handle_message(message)
+
     def clean_llm_response(self, response: str) -> str:
         """Clean LLM response to extract only YAML content"""
         # Remove markdown code blocks
@@ -280,20 +714,20 @@ Respond with ONLY the YAML content, no other text."""
         
         return response.strip()
 
-    def process_with_llm(self, patient_data: str) -> str:
+    def process_with_llm(self, patient_data: str, instruction: str = "Process this patient data and create a comprehensive EHR YAML file") -> str:
         """Process patient data through LLM to generate EHR YAML"""
         try:
-            response = self.client.chat.completions.create(
+            raw_response = self.gateway.chat(
                 model=self.llm_model,
                 messages=[
                     {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": f"Process this patient data and create a comprehensive EHR YAML file:\n\n{patient_data}"}
+                    {"role": "user", "content": f"{instruction}:\n\n{patient_data}"}
                 ],
                 temperature=0.1,  # Low temperature for consistent medical documentation
-                max_tokens=2000
+                max_tokens=2000,
+                priority=Priority.BACKGROUND
             )
             
-            raw_response = response.choices[0].message.content
             cleaned_response = self.clean_llm_response(raw_response)
             
             return cleaned_response
@@ -306,16 +740,20 @@ Respond with ONLY the YAML content, no other text."""
         if not filename:
             filename = self.get_next_sequential_filename()
         
-        filepath = self.output_dir / filename
-        
         try:
-            with open(filepath, 'w') as f:
-                f.write(yaml_content)
+            # Write then rename so readers never see a half-written (or just reserved, empty) file
+            filepath = self.ehr_store.write_text(filename, yaml_content, tmp_tag=self.worker_id)
             print(f"✅ EHR file saved: {filepath}")
-            return str(filepath)
         except Exception as e:
             print(f"❌ Error saving EHR file: {e}")
             return None
+        
+        # Compact abstract used by the chatbot for cross-patient questions
+        try:
+            write_summary(filepath, yaml.safe_load(yaml_content))
+        except Exception as e:
+            print(f"⚠️  Could not write EHR summary for {filename}: {e}")
+        return str(filepath)
 
     def validate_yaml(self, yaml_content: str) -> bool:
         """Validate that the generated content is proper YAML"""
@@ -343,18 +781,17 @@ Respond with ONLY the YAML content, no other text."""
                 context += "\n---\n"
             
             # Generate response using LLM
-            response = self.client.chat.completions.create(
+            return self.gateway.chat(
                 model=self.llm_model,
                 messages=[
                     {"role": "system", "content": "You are a medical expert answering questions based on EHR data. Provide professional medical insights while maintaining patient confidentiality. Always include appropriate disclaimers about seeking professional medical care."},
                     {"role": "user", "content": f"Question: {question}\n\nContext: {context}"}
                 ],
                 temperature=0.1,
-                max_tokens=1000
+                max_tokens=1000,
+                priority=Priority.INTERACTIVE
             )
             
-            return response.choices[0].message.content
-            
         except Exception as e:
             print(f"❌ Error answering medical question: {e}")
             return "Error processing medical query."
@@ -372,12 +809,12 @@ Respond with ONLY the YAML content, no other text."""
                 # Process patient data and generate EHR YAML
                 print("🏥 Processing patient data for EHR generation...")
                 
-                ehr_yaml = self.process_with_llm(content)
+                ehr_yaml = await asyncio.to_thread(self.process_with_llm, content)
                 
                 if ehr_yaml and self.validate_yaml(ehr_yaml):
                     # Save to file with sequential naming
                     sequential_filename = self.get_next_sequential_filename()
-                    filepath = self.save_ehr_yaml(ehr_yaml, sequential_filename)
+                    filepath = await asyncio.to_thread(self.save_ehr_yaml, ehr_yaml, sequential_filename)
                     
                     # Send response back through Coral
                     response = {
@@ -386,7 +823,8 @@ Respond with ONLY the YAML content, no other text."""
                         "filepath": filepath,
                         "filename": sequential_filename,
                         "sender": self.agent_id,
-                        "recipient": sender
+                        "recipient": sender,
+                        "thread_id": message.get("thread_id")
                     }
                     await self.send_coral_message(response)
                     
@@ -397,13 +835,20 @@ Respond with ONLY the YAML content, no other text."""
                 # Answer medical questions using EHR database
                 print("🩺 Processing medical query with EHR database...")
                 
-                medical_response = self.answer_medical_question(content)
+                # Only case and whitespace are folded: "BP > 140?" and "BP < 140?" are different questions
+                key = (" ".join(str(content).lower().split()), self.database_version)
+                if self.query_flights.in_flight(key):
+                    print("🔗 Joining identical medical query already in progress")
+                medical_response = await self.query_flights.do(
+                    key, lambda: asyncio.to_thread(self.answer_medical_question, content)
+                )
                 
                 response = {
                     "type": "medical_response",
                     "content": medical_response,
                     "sender": self.agent_id,
-                    "recipient": sender
+                    "recipient": sender,
+                    "thread_id": message.get("thread_id")
                 }
                 await self.send_coral_message(response)
                 
@@ -413,16 +858,18 @@ Respond with ONLY the YAML content, no other text."""
     async def send_coral_message(self, message: dict):
         """Send message through Coral protocol"""
         try:
-            # In a real implementation, this would use Coral's MCP protocol
+            if self.coral is None or not message.get("thread_id"):
+                print(f"⚠️  No Coral thread to send {message['type']} to")
+                return
             print(f"📤 Sending message via Coral: {message['type']}")
-            # Simulate sending message
-            pass
+            mentions = [message["recipient"]] if message.get("recipient") else []
+            self.coral.send(message["thread_id"], json.dumps(message, default=str), mentions)
         except Exception as e:
             print(f"❌ Error sending Coral message: {e}")
 
     async def run(self):
         """Main agent loop"""
-        print(f"🚀 Starting EHR Agent ({self.agent_id})")
+        print(f"🚀 Starting EHR Agent ({self.agent_id}, worker {self.worker_id})")
         print(f"🔧 Using {self.llm_provider} with model {self.llm_model}")
         print(f"📁 Output directory: {self.output_dir}")
         print(f"📋 Patient notes directory: {self.patient_notes_dir}")
@@ -430,22 +877,52 @@ Respond with ONLY the YAML content, no other text."""
         # Connect to Coral server
         await self.connect_to_coral()
         
+        # Listen for direct handoffs before the initial scan so nothing saved meanwhile is missed
+        handoff_event = asyncio.Event()
+        handoff_server = await self.handoff_queue.listen(handoff_event)
+        # Only take back handoffs whose worker has been gone longer than a lease lifetime
+        recovered = self.handoff_queue.recover(stale_after=self.lease_ttl)
+        if recovered:
+            print(f"♻️  Requeued {recovered} unacknowledged session handoff(s)")
+        
         # Initial processing of existing patient notes
         print("🔄 Processing existing patient notes...")
-        self.process_patient_notes()
+        _, self._notes_offset = self.notes_store.changes()
+        # Note processing runs in a thread so Coral messages are still served meanwhile
+        await asyncio.to_thread(self.process_patient_notes)
+        await asyncio.to_thread(self.drain_handoff_queue)
         
         print("✅ EHR Agent is running and ready!")
         print("🔄 Monitoring for new patient notes and listening for queries...")
         
         # Main event loop
+        last_rescan = datetime.now().timestamp()
         try:
             while True:
-                # Check for new patient notes every 30 seconds
-                self.watch_for_new_notes()
-                await asyncio.sleep(30)
+                # Wake on handoff, or at most every 30 seconds to pick up queued retries
+                try:
+                    await asyncio.wait_for(handoff_event.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    pass
+                handoff_event.clear()
+                if self.handoff_queue.recover(stale_after=self.lease_ttl):
+                    print("♻️  Requeued session handoff(s) left by a crashed worker")
+                await asyncio.to_thread(self.drain_handoff_queue)
+                
+                # Periodic rescan catches notes written without a handoff
+                if datetime.now().timestamp() - last_rescan >= self.rescan_interval:
+                    await asyncio.to_thread(self.watch_for_new_notes)
+                    last_rescan = datetime.now().timestamp()
                 
         except KeyboardInterrupt:
             print("\n🛑 EHR Agent shutting down...")
+        finally:
+            self.coral_task.cancel()
+            handoff_server.close()
+            self.leases.close()
+            self.processed_ledger.compact()
+            self.ehr_database.report()
+            self.resident_ehrs.report()
 
 if __name__ == "__main__":
     # Load environment variables
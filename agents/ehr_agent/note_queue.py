@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Urgency-aware scheduling of patient notes waiting for EHR processing.
+
+Each pending notes file is scored from cheap signals in its not yet processed
+sessions, which are already parsed: EMERGENCY ESCALATION notes written by
+TriageAgent.emergency_escalation, the urgency of the draft EHR saved with the
+session, red-flag keywords and how recently the file changed. The score puts
+it in one of three classes:
+
+  critical  escalations and critical drafts; always served first
+  high      red-flag symptoms or a high-urgency draft
+  routine   everything else
+
+Within a class higher scores go first, then older entries. Starvation is
+prevented by aging: once an entry has waited ``aging_seconds`` it competes
+one class higher, ahead of that class's fresh entries, so a steady stream of
+high-urgency notes cannot hold routine ones back forever. Aging is capped at
+one level and never reaches the critical class, so critical notes always go
+first.
+
+Queue depth, throughput and wait times per class are printed after each
+drained batch and written in Prometheus text format.
+"""
+
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+PRIORITY_CLASSES = ["critical", "high", "routine"]
+
+ESCALATION_MARKER = "EMERGENCY ESCALATION"
+RED_FLAG_KEYWORDS = [
+    "chest pain", "difficulty breathing", "shortness of breath", "can't breathe",
+    "unconscious", "seizure", "stroke", "severe bleeding", "suicidal", "overdose",
+]
+RECENT_SECONDS = 600
+WAIT_WINDOW = 500
+
+
+def score_note(data: Optional[Dict], last_modified: float, skip_sessions: int = 0) -> Tuple[int, str]:
+    """Score a parsed notes file and return (score, priority class)
+
+    ``skip_sessions`` leading sessions were already turned into an EHR, so
+    an old escalation does not make every later update critical.
+    """
+    score = 0
+    texts: List[str] = []
+    sessions = (data or {}).get('sessions') or []
+    if skip_sessions > len(sessions):
+        skip_sessions = 0
+    for session in sessions[skip_sessions:]:
+        texts.append(str(session.get('chief_complaint') or ''))
+        texts.extend(str(s) for s in session.get('symptoms') or [])
+        for note in session.get('notes') or []:
+            content = str((note or {}).get('content') or '')
+            if content.startswith(ESCALATION_MARKER):
+                score += 100
+            texts.append(content)
+        draft_urgency = ((session.get('draft_ehr') or {}).get('urgency_level') or '').lower()
+        score += {'critical': 100, 'high': 50, 'medium': 10}.get(draft_urgency, 0)
+
+    text = " ".join(texts).lower()
+    score += 40 * sum(1 for keyword in RED_FLAG_KEYWORDS if keyword in text)
+    if time.time() - last_modified < RECENT_SECONDS:
+        score += 5
+
+    if score >= 100:
+        return score, "critical"
+    if score >= 40:
+        return score, "high"
+    return score, "routine"
+
+
+class NoteQueue:
+    def __init__(self, aging_seconds: float = 120, metrics_file: str = "logs/ehr_queue_metrics.prom"):
+        self.aging_seconds = aging_seconds
+        self.metrics_file = Path(metrics_file)
+        # Each entry is in its class's heap (score order) and FIFO (arrival order);
+        # taking it from one marks it done and the other skips it lazily
+        self._heaps: Dict[str, List] = {name: [] for name in PRIORITY_CLASSES}
+        self._fifos: Dict[str, deque] = {name: deque() for name in PRIORITY_CLASSES}
+        self._depth = {name: 0 for name in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+        self.enqueued = {name: 0 for name in PRIORITY_CLASSES}
+        self.processed = {name: 0 for name in PRIORITY_CLASSES}
+        self.aged = {name: 0 for name in PRIORITY_CLASSES}
+        self.waits = {name: deque(maxlen=WAIT_WINDOW) for name in PRIORITY_CLASSES}
+
+    def __len__(self) -> int:
+        return sum(self._depth.values())
+
+    def push(self, item: Any, score: int, priority: str):
+        # [-score, enqueued at, seq, item, done]
+        entry = [-score, time.monotonic(), next(self._seq), item, False]
+        heapq.heappush(self._heaps[priority], entry)
+        self._fifos[priority].append(entry)
+        self._depth[priority] += 1
+        self.enqueued[priority] += 1
+
+    def _oldest(self, name: str) -> Optional[List]:
+        fifo = self._fifos[name]
+        while fifo and fifo[0][4]:
+            fifo.popleft()
+        return fifo[0] if fifo else None
+
+    def _best(self, name: str) -> List:
+        heap = self._heaps[name]
+        while heap[0][4]:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def pop(self) -> Tuple[Any, str, float]:
+        """Next item as (item, priority class, seconds waited)"""
+        now = time.monotonic()
+        best, best_key = None, None
+        for rank, name in enumerate(PRIORITY_CLASSES):
+            oldest = self._oldest(name)
+            if oldest is None:
+                continue
+            # One level up at most, and never into the critical class
+            aged = rank > 0 and now - oldest[1] >= self.aging_seconds
+            effective = max(1, rank - 1) if aged else rank
+            key = (effective, not aged, rank)
+            if best_key is None or key < best_key:
+                best, best_key = name, key
+        if best is None:
+            raise IndexError("pop from an empty NoteQueue")
+
+        if not best_key[1]:
+            # Served because it waited too long: take the oldest entry, not the highest score
+            entry = self._fifos[best].popleft()
+            self.aged[best] += 1
+        else:
+            entry = self._best(best)
+            heapq.heappop(self._heaps[best])
+        entry[4] = True
+        self._depth[best] -= 1
+        waited = now - entry[1]
+        self.processed[best] += 1
+        self.waits[best].append(waited)
+        return entry[3], best, waited
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for name in PRIORITY_CLASSES:
+            waits = sorted(self.waits[name])
+            result[name] = {
+                "depth": self._depth[name],
+                "enqueued": self.enqueued[name],
+                "processed": self.processed[name],
+                "aged": self.aged[name],
+                "wait_mean_s": sum(waits) / len(waits) if waits else 0.0,
+                "wait_p95_s": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+                "wait_max_s": waits[-1] if waits else 0.0,
+            }
+        return result
+
+    def report(self):
+        """Print a one-line summary per class and rewrite the metrics file"""
+        metrics = self.metrics()
+        for name, m in metrics.items():
+            if m["enqueued"]:
+                print(f"📊 {name}: depth {m['depth']}, processed {m['processed']} ({m['aged']} aged), "
+                      f"wait mean {m['wait_mean_s']:.1f}s p95 {m['wait_p95_s']:.1f}s max {m['wait_max_s']:.1f}s")
+
+        lines = []
+        for metric, help_text, key in (
+            ("ehr_queue_depth", "Notes files waiting per priority class", "depth"),
+            ("ehr_queue_processed_total", "Notes files taken off the queue per priority class", "processed"),
+            ("ehr_queue_aged_total", "Notes files served early because of aging", "aged"),
+            ("ehr_queue_wait_mean_seconds", "Mean queue wait over recent notes", "wait_mean_s"),
+            ("ehr_queue_wait_p95_seconds", "95th percentile queue wait over recent notes", "wait_p95_s"),
+            ("ehr_queue_wait_max_seconds", "Longest queue wait over recent notes", "wait_max_s"),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {'counter' if metric.endswith('_total') else 'gauge'}")
+            for name, m in metrics.items():
+                lines.append(f'{metric}{{priority="{name}"}} {m[key]}')
+        try:
+            self.metrics_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.metrics_file.with_suffix(".tmp")
+            tmp_path.write_text("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.metrics_file)
+        except OSError as e:
+            print(f"⚠️  Could not write queue metrics: {e}")
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Incremental draft EHR built while the call is still in progress.
+
+Every note added to the PatientSession updates the draft straight away with
+deterministic rules (complaint, symptoms, urgency from escalations and red-flag
+keywords). Clinically relevant notes are also queued for a small background
+LLM pass that fills in symptom severity/duration and refines urgency. The
+draft is saved with the session notes, so the EHR agent has a structured
+record at hang-up instead of running one large extraction afterwards.
+"""
+
+import asyncio
+import json
+import logging
+import re
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from livekit.agents.llm import ChatContext
+
+logger = logging.getLogger("medical-agent.draft-ehr")
+
+URGENCY_ORDER = ["low", "medium", "high", "critical"]
+
+# Symptoms that warrant at least a "high" urgency without waiting for the LLM
+RED_FLAG_KEYWORDS = [
+    "chest pain", "difficulty breathing", "shortness of breath", "can't breathe",
+    "unconscious", "seizure", "stroke", "severe bleeding", "suicidal", "overdose",
+]
+
+# Notes generated by agent bookkeeping carry no clinical content
+BOOKKEEPING_PREFIXES = ("Entered ", "Exited ", "Transferred from ")
+CLINICAL_AGENTS = {"triage", "TriageAgent"}
+
+REFINE_PROMPT = """You update a draft medical record during a live triage call.
+Given the current draft and a new note, respond with ONLY a JSON object:
+{"symptoms": [{"symptom": "", "severity": "", "duration": ""}], "urgency_level": "low|medium|high|critical"}
+Include only symptoms mentioned in the draft or the note. Use null for unknown values."""
+
+
+def _max_urgency(current: Optional[str], candidate: Optional[str]) -> Optional[str]:
+    if candidate not in URGENCY_ORDER:
+        return current
+    if current not in URGENCY_ORDER:
+        return candidate
+    return max(current, candidate, key=URGENCY_ORDER.index)
+
+
+class DraftEHRExtractor:
+    """Keeps a draft EHR in sync with a PatientSession as notes arrive"""
+
+    def __init__(self, session, llm=None):
+        self.session = session
+        self.llm = llm
+        self.draft: Dict[str, Any] = {
+            "patient_info": {"name": None},
+            "chief_complaint": None,
+            "symptoms": [],
+            "urgency_level": None,
+            "updated_at": None,
+        }
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.llm is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def notify(self, note: Dict[str, Any]):
+        """Called for every note added to the session"""
+        self._apply_rules(note)
+        content = note.get("content", "")
+        if self._task is not None and note.get("agent") in CLINICAL_AGENTS \
+                and not content.startswith(BOOKKEEPING_PREFIXES):
+            self._queue.put_nowait(content)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return json.loads(json.dumps(self.draft))
+
+    def _apply_rules(self, note: Dict[str, Any]):
+        draft = self.draft
+        session = self.session
+        draft["patient_info"]["name"] = session.patient_name
+        draft["chief_complaint"] = session.chief_complaint
+
+        known = {s["symptom"].lower() for s in draft["symptoms"]}
+        for symptom in session.symptoms:
+            if symptom.lower() not in known:
+                draft["symptoms"].append({"symptom": symptom, "severity": None, "duration": None})
+                known.add(symptom.lower())
+
+        content = note.get("content", "")
+        if content.startswith("EMERGENCY ESCALATION"):
+            level = content.split(":", 1)[-1].strip().lower()
+            draft["urgency_level"] = _max_urgency(
+                draft["urgency_level"], "critical" if level in ("high", "emergency", "urgent") else "medium"
+            )
+
+        clinical_text = " ".join([session.chief_complaint or ""] + session.symptoms).lower()
+        if any(keyword in clinical_text for keyword in RED_FLAG_KEYWORDS):
+            draft["urgency_level"] = _max_urgency(draft["urgency_level"], "high")
+        elif session.chief_complaint:
+            draft["urgency_level"] = _max_urgency(draft["urgency_level"], "low")
+
+        draft["updated_at"] = datetime.now().isoformat()
+
+    async def _run(self):
+        while True:
+            notes = [await self._queue.get()]
+            # Coalesce everything queued meanwhile into one small call
+            while not self._queue.empty():
+                notes.append(self._queue.get_nowait())
+            try:
+                await self._refine("\n".join(notes))
+            except Exception as e:
+                logger.warning(f"Draft EHR refinement failed: {e}")
+            finally:
+                for _ in notes:
+                    self._queue.task_done()
+
+    async def _refine(self, note_text: str):
+        chat_ctx = ChatContext()
+        chat_ctx.add_message(role="system", content=REFINE_PROMPT)
+        chat_ctx.add_message(
+            role="user",
+            content=f"Current draft:\n{json.dumps(self.draft)}\n\nNew note:\n{note_text}",
+        )
+
+        response = ""
+        async with self.llm.chat(chat_ctx=chat_ctx) as stream:
+            async for chunk in stream:
+                if chunk.delta and chunk.delta.content:
+                    response += chunk.delta.content
+
+        match = re.search(r"\{.*\}", response, flags=re.DOTALL)
+        if not match:
+            return
+        update = json.loads(match.group(0))
+
+        by_name = {s["symptom"].lower(): s for s in self.draft["symptoms"]}
+        for symptom in update.get("symptoms") or []:
+            name = (symptom.get("symptom") or "").strip()
+            if not name:
+                continue
+            existing = by_name.get(name.lower())
+            if existing is None:
+                existing = {"symptom": name, "severity": None, "duration": None}
+                self.draft["symptoms"].append(existing)
+                by_name[name.lower()] = existing
+            for key in ("severity", "duration"):
+                if symptom.get(key):
+                    existing[key] = symptom[key]
+
+        self.draft["urgency_level"] = _max_urgency(self.draft["urgency_level"], update.get("urgency_level"))
+        self.draft["updated_at"] = datetime.now().isoformat()
+
+    async def drain(self, timeout: float = 3.0):
+        """Wait briefly for queued refinements before the final save"""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Draft EHR refinement still pending at session end")
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Per-turn latency histograms for the voice pipeline.
+
+Stages recorded (all in seconds, keyed by agent name):
+  eou          end-of-speech detection delay
+  stt_final    time from end of speech to the final transcript
+  llm_ttft     LLM time to first token
+  tts_ttfb     TTS time to first audio byte
+  tool:<name>  function tool body, up to its spoken reply
+  say:<name>   playout of a function tool's spoken reply
+  handoff      time from a transfer request until the next agent is active
+
+p95 targets are per stage: LATENCY_P95_TARGETS_MS takes "stage=ms" pairs,
+where a stage is either exact ("tool:schedule_appointment") or a family
+("tool"), and LATENCY_P95_TARGET_MS is the default for the rest. Playout
+grows with the length of the reply, so say:* stages are only checked against
+an explicit target.
+
+One recorder is shared by every call a worker process handles, so the
+histograms and p95 checks cover more than a single conversation. Histograms
+are written in Prometheus text exposition format to a local file so they can
+be scraped by a node exporter textfile collector or read directly.
+"""
+
+import bisect
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Hashable, Optional, Tuple
+
+from livekit.agents import metrics
+
+logger = logging.getLogger("medical-agent.latency")
+
+# Bucket upper bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+# Recent samples kept per histogram for percentile estimates
+SAMPLE_WINDOW = 1000
+
+# Minimum seconds between metrics file rewrites
+FLUSH_INTERVAL = 10.0
+
+# Stage families that the default p95 target does not apply to
+UNTARGETED_STAGES = ("say",)
+
+
+def parse_targets(spec: str) -> Dict[str, float]:
+    """Parse "stage=ms,stage=ms" into seconds per stage"""
+    targets = {}
+    for item in (spec or "").split(","):
+        stage, _, ms = item.partition("=")
+        if stage.strip() and ms.strip():
+            targets[stage.strip()] = float(ms) / 1000
+    return targets
+
+
+class Histogram:
+    """Cumulative bucket counts plus a sliding window of raw samples"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.samples.append(value)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class LatencyRecorder:
+    """Collects stage latencies per agent and flushes them to a metrics file"""
+
+    def __init__(self, metrics_file: str = None, p95_target_ms: float = None, p95_targets_ms: Dict[str, float] = None):
+        self.metrics_file = Path(metrics_file or os.getenv("LATENCY_METRICS_FILE", "logs/latency_metrics.prom"))
+        target = p95_target_ms if p95_target_ms is not None else os.getenv("LATENCY_P95_TARGET_MS")
+        self.p95_target = float(target) / 1000 if target else None
+        if p95_targets_ms is not None:
+            self.p95_targets = {stage: ms / 1000 for stage, ms in p95_targets_ms.items()}
+        else:
+            self.p95_targets = parse_targets(os.getenv("LATENCY_P95_TARGETS_MS", ""))
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        # Open handoffs per call, since calls share the recorder
+        self._handoffs_started: Dict[Hashable, float] = {}
+        self._last_flush = 0.0
+
+    def observe(self, agent: str, stage: str, seconds: float):
+        """Record one latency sample"""
+        if seconds is None or seconds < 0:
+            return
+        key = (agent or "unknown", stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+        target = self.target_for(stage)
+        if target and histogram.count >= 20:
+            p95 = histogram.percentile(95)
+            if p95 > target:
+                logger.warning(f"{key[0]} {stage} p95 {p95 * 1000:.0f}ms exceeds target {target * 1000:.0f}ms")
+
+    def target_for(self, stage: str) -> Optional[float]:
+        """p95 target in seconds for a stage: exact match, then its family, then the default"""
+        family = stage.split(":", 1)[0]
+        if stage in self.p95_targets:
+            return self.p95_targets[stage]
+        if family in self.p95_targets:
+            return self.p95_targets[family]
+        return None if family in UNTARGETED_STAGES else self.p95_target
+
+    @contextmanager
+    def time(self, agent: str, stage: str):
+        """Time a block of code, e.g. a function tool body or its spoken reply"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(agent, stage, time.perf_counter() - start)
+
+    def start_handoff(self, agent: str, call: Hashable = None):
+        self._handoffs_started[call] = time.perf_counter()
+
+    def end_handoff(self, agent: str, call: Hashable = None):
+        """Close a handoff opened by start_handoff for the same call, attributed to the receiving agent"""
+        start = self._handoffs_started.pop(call, None)
+        if start is None:
+            return
+        self.observe(agent, "handoff", time.perf_counter() - start)
+
+    def on_pipeline_metrics(self, agent: str, collected):
+        """Map LiveKit pipeline metrics onto our stages"""
+        if isinstance(collected, metrics.EOUMetrics):
+            self.observe(agent, "eou", collected.end_of_utterance_delay)
+            self.observe(agent, "stt_final", collected.transcription_delay)
+        elif isinstance(collected, metrics.LLMMetrics):
+            self.observe(agent, "llm_ttft", collected.ttft)
+        elif isinstance(collected, metrics.TTSMetrics):
+            self.observe(agent, "tts_ttfb", collected.ttfb)
+
+        if time.monotonic() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """p50/p95 per agent and stage, in milliseconds"""
+        result = {}
+        for (agent, stage), histogram in sorted(self.histograms.items()):
+            result[f"{agent}/{stage}"] = {
+                "count": histogram.count,
+                "p50_ms": round(histogram.percentile(50) * 1000, 1),
+                "p95_ms": round(histogram.percentile(95) * 1000, 1),
+            }
+        return result
+
+    def flush(self):
+        """Write all histograms to the metrics file in Prometheus text format"""
+        self._last_flush = time.monotonic()
+        lines = [
+            "# HELP voice_stage_latency_seconds Voice pipeline stage latency per agent",
+            "# TYPE voice_stage_latency_seconds histogram",
+        ]
+        for (agent, stage), histogram in sorted(self.histograms.items()):
+            labels = f'agent="{agent}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'voice_stage_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'voice_stage_latency_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"voice_stage_latency_seconds_sum{{{labels}}} {histogram.total:.6f}")
+            lines.append(f"voice_stage_latency_seconds_count{{{labels}}} {histogram.count}")
+
+        try:
+            self.metrics_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.metrics_file.with_suffix(".tmp")
+            tmp_path.write_text("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.metrics_file)
+        except OSError as e:
+            logger.error(f"Error writing latency metrics: {e}")
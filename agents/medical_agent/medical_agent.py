@@ -12,11 +12,22 @@ import sys
 import yaml
 
 from dotenv import load_dotenv
-from livekit.agents import JobContext, WorkerOptions, cli
+from livekit.agents import JobContext, JobProcess, MetricsCollectedEvent, WorkerOptions, cli
+from livekit.agents import llm as lk_llm
 from livekit.agents.llm import function_tool
 from livekit.agents.voice import Agent, AgentSession, RunContext
 from livekit.plugins import cartesia, deepgram, openai, groq, silero
 from livekit.agents import mcp
+from openai import AsyncOpenAI
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.handoff_queue import HandoffQueue
+from common.llm_gateway import PROVIDER_BASE_URLS, Priority, get_gateway
+from common.sharded_store import ShardedStore
+
+from draft_ehr import DraftEHRExtractor
+from latency_metrics import LatencyRecorder
+from tts_cache import TTSAudioCache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,20 +36,44 @@ logger = logging.getLogger("medical-agent")
 # Load environment variables
 load_dotenv()
 
+# Fixed lines the agents speak on every call; pre-rendered into the TTS cache at worker start
+STATIC_UTTERANCES = {
+    "triage_to_support": "I'll connect you with our Patient Support team who can help with scheduling and medical services.",
+    "triage_to_billing": "I'll transfer you to our Billing department who can assist with insurance and payment matters.",
+    "support_to_billing": "Let me connect you with our Billing team for insurance and payment assistance.",
+    "support_to_triage": "Let me connect you back with our Triage team for medical assessment.",
+    "billing_to_support": "Let me connect you with Patient Support to help with scheduling.",
+    "billing_to_triage": "Let me connect you with our Triage team for medical concerns.",
+    "patient_info_ack": "Thank you. I've recorded your information. Let me help direct you to the appropriate department.",
+    "insurance_ack": "Thank you. I've recorded your insurance information and will verify your coverage.",
+    "billing_question_ack": "I've noted your question. Our billing team will follow up with detailed information.",
+    "appointment_ack": "Our scheduling team will contact you to confirm.",
+    "emergency": "This appears to be an urgent medical situation. Please call 911 immediately or go to your nearest emergency room.",
+    "non_emergency": "Based on your symptoms, I recommend scheduling an appointment with your healthcare provider soon.",
+    "goodbye": "Thank you for visiting us today. Take care and have a great day!",
+}
+
 def create_directory_structure():
     """Create necessary directories"""
     Path("patient_notes").mkdir(exist_ok=True)
     Path("logs").mkdir(exist_ok=True)
 
-def get_patient_file_path(patient_identifier: str) -> str:
-    """Get consistent file path for a patient"""
+notes_store = ShardedStore("patient_notes")
+
+def get_patient_filename(patient_identifier: str) -> str:
+    """Get consistent file name for a patient"""
     # Sanitize filename and ensure consistency
     safe_name = "".join(c for c in patient_identifier.lower() if c.isalnum() or c in (' ', '-', '_')).rstrip()
     safe_name = safe_name.replace(' ', '_')
-    return f"patient_notes/{safe_name}.yaml"
+    return f"{safe_name}.yaml"
+
+def get_patient_file_path(patient_identifier: str) -> str:
+    """Get consistent file path for a patient"""
+    return str(notes_store.resolve(get_patient_filename(patient_identifier)))
 
 def save_patient_notes(notes_data: Dict[str, Any], patient_identifier: str) -> str:
     """Save or update patient notes to a single file per patient"""
+    filename = get_patient_filename(patient_identifier)
     filepath = get_patient_file_path(patient_identifier)
     
     existing_data = {}
@@ -67,14 +102,23 @@ def save_patient_notes(notes_data: Dict[str, Any], patient_identifier: str) -> s
     })
     
     try:
-        with open(filepath, 'w') as f:
-            yaml.dump(existing_data, f, default_flow_style=False, sort_keys=False)
+        # Written atomically into its shard and journaled so readers never list the directory
+        filepath = str(notes_store.write_text(filename, yaml.dump(existing_data, default_flow_style=False, sort_keys=False)))
         logger.info(f"Patient notes saved to {filepath}")
-        return filepath
     except Exception as e:
         logger.error(f"Error saving notes: {e}")
         raise
 
+    # Hand the completed session straight to the EHR agent; the notes file remains the source of truth
+    try:
+        HandoffQueue(os.getenv("HANDOFF_QUEUE_DIR", "handoff_queue")).enqueue({
+            "source_file": filename,
+            "session_id": session_data['session_id'],
+        })
+    except OSError as e:
+        logger.warning(f"Could not enqueue EHR handoff, EHR agent will pick up notes on rescan: {e}")
+    return filepath
+
 def load_patient_notes(patient_identifier: str) -> Optional[Dict[str, Any]]:
     """Load patient notes from file"""
     filepath = get_patient_file_path(patient_identifier)
@@ -91,16 +135,13 @@ def load_patient_notes(patient_identifier: str) -> Optional[Dict[str, Any]]:
 
 def list_patient_notes() -> list:
     """List available patient note files"""
-    notes_dir = Path("patient_notes")
-    if not notes_dir.exists():
-        return []
-    
     files = []
-    for file_path in notes_dir.glob("*.yaml"):
+    for filename in notes_store.names():
+        file_path = notes_store.resolve(filename)
         try:
             stat = file_path.stat()
             files.append({
-                'filename': file_path.name,
+                'filename': filename,
                 'path': str(file_path),
                 'created': datetime.fromtimestamp(stat.st_ctime),
                 'modified': datetime.fromtimestamp(stat.st_mtime)
@@ -110,23 +151,50 @@ def list_patient_notes() -> list:
     
     return sorted(files, key=lambda x: x['modified'], reverse=True)
 
-def get_llm_instance():
+def get_llm_instance(priority: int = Priority.VOICE):
     """Get LLM instance based on environment configuration"""
-    llm_provider = os.getenv("LLM_PROVIDER", "groq").lower()
     llm_model = os.getenv("LLM_MODEL", "llama-3.1-8b-instant")
-    api_key = os.getenv("API_KEY")
+    gateway = get_gateway()
+    
+    instances = []
+    for provider in gateway.providers:
+        llm_provider = provider.name
+        if llm_provider not in ("openai", "groq"):
+            logger.warning(f"Unsupported LLM provider: {llm_provider}. Falling back to Groq.")
+            llm_provider = "groq"
+        
+        # Voice turns share the process-wide rate limiter at the highest priority, over this job's pooled connections
+        client = AsyncOpenAI(
+            api_key=provider.api_key,
+            base_url=PROVIDER_BASE_URLS[llm_provider],
+            http_client=gateway.async_http_client(priority, provider),
+        )
+        llm_class = openai.LLM if llm_provider == "openai" else groq.LLM
+        instances.append(llm_class(model=provider.model or llm_model, client=client))
     
-    if llm_provider == "openai":
-        return openai.LLM(model=llm_model, api_key=api_key)
-    elif llm_provider == "groq":
-        return groq.LLM(model=llm_model, api_key=api_key)
-    else:
-        logger.warning(f"Unsupported LLM provider: {llm_provider}. Falling back to Groq.")
-        return groq.LLM(model=llm_model, api_key=api_key)
-
-@dataclass
+    if len(instances) == 1:
+        return instances[0]
+    # Fail over to the secondary provider when the primary is slow or marked unavailable
+    return lk_llm.FallbackAdapter(
+        instances,
+        attempt_timeout=float(os.getenv("LLM_FAILOVER_TIMEOUT_S", "2.5")),
+        max_retry_per_llm=0,
+    )
+
+def get_tts_instance(**kwargs):
+    """Get TTS instance based on environment configuration"""
+    voice = os.getenv("CARTESIA_VOICE")
+    if voice:
+        kwargs["voice"] = voice
+    return cartesia.TTS(**kwargs)
+
+def get_tts_voice_key() -> str:
+    """Identify the configured TTS voice for audio cache lookups"""
+    return f"cartesia:{os.getenv('CARTESIA_VOICE', 'default')}"
+
+@dataclass(slots=True)
 class PatientSession:
-    """Stores patient data throughout the session"""
+    """Stores patient data throughout the session (slotted: one per live call, no per-instance dict)"""
     patient_name: Optional[str] = None
     patient_id: Optional[str] = None
     chief_complaint: Optional[str] = None
@@ -139,6 +207,7 @@ class PatientSession:
     session_start: datetime = field(default_factory=datetime.now)
     auto_save_enabled: bool = True
     conversation_ended: bool = False
+    draft_extractor: Optional[DraftEHRExtractor] = field(default=None, repr=False, compare=False)
 
     def add_note(self, note: str, agent_type: str = "system"):
         """Add a note to the patient session"""
@@ -149,6 +218,8 @@ class PatientSession:
         }
         self.notes.append(note_entry)
         logger.info(f"Added note: {note_entry}")
+        if self.draft_extractor:
+            self.draft_extractor.notify(note_entry)
 
     def get_patient_identifier(self) -> str:
         """Get consistent patient identifier for file naming"""
@@ -161,7 +232,7 @@ class PatientSession:
 
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary for saving"""
-        return {
+        data = {
             "patient_name": self.patient_name,
             "patient_id": self.patient_id,
             "chief_complaint": self.chief_complaint,
@@ -173,6 +244,9 @@ class PatientSession:
             "session_start": self.session_start.isoformat(),
             "session_end": datetime.now().isoformat()
         }
+        if self.draft_extractor:
+            data["draft_ehr"] = self.draft_extractor.snapshot()
+        return data
 
     def auto_save_notes(self):
         """Automatically save notes if enabled and there's data"""
@@ -194,6 +268,8 @@ class MedicalAgentData:
     agents: Dict[str, Agent] = field(default_factory=dict)
     previous_agent: Optional[Agent] = None
     ctx: Optional[JobContext] = None
+    tts_cache: Optional[TTSAudioCache] = None
+    latency: LatencyRecorder = field(default_factory=LatencyRecorder)
 
 RunContext_T = RunContext[MedicalAgentData]
 
@@ -205,7 +281,7 @@ class BaseMedicalAgent(Agent):
             instructions=instructions,
             stt=deepgram.STT(),
             llm=get_llm_instance(),
-            tts=cartesia.TTS(),
+            tts=get_tts_instance(),
             vad=silero.VAD.load()
         )
         self.agent_name = agent_name
@@ -266,6 +342,7 @@ class BaseMedicalAgent(Agent):
             )
         
         await self.update_chat_ctx(chat_ctx)
+        userdata.latency.end_handoff(self.agent_name, call=id(userdata))
         
         # Only generate reply if conversation hasn't ended
         if not userdata.patient_session.conversation_ended:
@@ -309,6 +386,15 @@ class BaseMedicalAgent(Agent):
         
         return " | ".join(context_parts) if context_parts else "New patient session"
 
+    async def _say_static(self, text: str):
+        """Speak a fixed utterance, playing pre-rendered audio when it is cached"""
+        cache = self.session.userdata.tts_cache
+        audio = cache.frames(get_tts_voice_key(), text) if cache else None
+        if audio is not None:
+            await self.session.say(text, audio=audio)
+        else:
+            await self.session.say(text)
+
     async def _transfer_to_agent(self, agent_name: str, context: RunContext_T, message: str = None) -> Agent:
         """Transfer to another agent while preserving session data"""
         userdata = context.userdata
@@ -331,8 +417,9 @@ class BaseMedicalAgent(Agent):
         userdata.previous_agent = current_agent
         
         if message:
-            await self.session.say(message)
+            await self._say_static(message)
         
+        userdata.latency.start_handoff(self.agent_name, call=id(userdata))
         return next_agent
     
     @function_tool
@@ -341,12 +428,15 @@ class BaseMedicalAgent(Agent):
         userdata = context.userdata
         userdata.patient_session.conversation_ended = True
 
+        if userdata.patient_session.draft_extractor:
+            await userdata.patient_session.draft_extractor.drain()
+
         # Save notes before closing
         filename = userdata.patient_session.auto_save_notes()
         if filename:
             logger.info(f"Final notes saved to {filename}")
 
-        await self.session.say("Thank you for visiting us today. Take care and have a great day!")
+        await self._say_static(STATIC_UTTERANCES["goodbye"])
         await asyncio.sleep(2)  # Let TTS finish
         
         logger.info("Ending conversation gracefully...")
@@ -356,6 +446,8 @@ class BaseMedicalAgent(Agent):
         except Exception as e:
             logger.error(f"Error closing session: {e}")
         
+        userdata.latency.flush()
+
         # Exit the program
         logger.info("Exiting program...")
         sys.exit(0)
@@ -397,48 +489,53 @@ class TriageAgent(BaseMedicalAgent):
         userdata = context.userdata
         session = userdata.patient_session
         
-        # Clean and validate inputs
-        name = name.strip() if name else None
-        complaint = complaint.strip() if complaint else None
-        symptoms_list = [s.strip() for s in symptoms.split(",") if s.strip()] if symptoms else []
-        
-        if name:
-            session.patient_name = name
-        if complaint:
-            session.chief_complaint = complaint
-        if symptoms_list:
-            session.symptoms = symptoms_list
-        
-        session.add_note(f"Patient information collected - Name: {name}, Complaint: {complaint}, Symptoms: {symptoms}", "triage")
-        logger.info(f"Collected patient info: {name}, {complaint}")
+        # The body and the spoken acknowledgement are timed as separate stages
+        with userdata.latency.time(self.agent_name, "tool:collect_patient_info"):
+            # Clean and validate inputs
+            name = name.strip() if name else None
+            complaint = complaint.strip() if complaint else None
+            symptoms_list = [s.strip() for s in symptoms.split(",") if s.strip()] if symptoms else []
+            
+            if name:
+                session.patient_name = name
+            if complaint:
+                session.chief_complaint = complaint
+            if symptoms_list:
+                session.symptoms = symptoms_list
+            
+            session.add_note(f"Patient information collected - Name: {name}, Complaint: {complaint}, Symptoms: {symptoms}", "triage")
+            logger.info(f"Collected patient info: {name}, {complaint}")
         
-        if name:
-            await self.session.say(f"Thank you {name}. I've recorded your information. Let me help direct you to the appropriate department.")
-        else:
-            await self.session.say("Thank you. I've recorded your information. Let me help direct you to the appropriate department.")
+        with userdata.latency.time(self.agent_name, "say:collect_patient_info"):
+            if name:
+                await self.session.say(f"Thank you {name}. I've recorded your information. Let me help direct you to the appropriate department.")
+            else:
+                await self._say_static(STATIC_UTTERANCES["patient_info_ack"])
 
     @function_tool 
     async def transfer_to_support(self, context: RunContext_T) -> Agent:
         """Transfer to patient support for appointments and general inquiries"""
-        message = "I'll connect you with our Patient Support team who can help with scheduling and medical services."
+        message = STATIC_UTTERANCES["triage_to_support"]
         return await self._transfer_to_agent("support", context, message)
 
     @function_tool
     async def transfer_to_billing(self, context: RunContext_T) -> Agent:
         """Transfer to billing for insurance and payment questions"""
-        message = "I'll transfer you to our Billing department who can assist with insurance and payment matters."
+        message = STATIC_UTTERANCES["triage_to_billing"]
         return await self._transfer_to_agent("billing", context, message)
 
     @function_tool
     async def emergency_escalation(self, urgency_level: str, context: RunContext_T):
         """Handle emergency situations"""
         userdata = context.userdata
-        userdata.patient_session.add_note(f"EMERGENCY ESCALATION: {urgency_level}", "triage")
+        with userdata.latency.time(self.agent_name, "tool:emergency_escalation"):
+            userdata.patient_session.add_note(f"EMERGENCY ESCALATION: {urgency_level}", "triage")
         
-        if urgency_level.lower() in ["high", "emergency", "urgent"]:
-            await self.session.say("This appears to be an urgent medical situation. Please call 911 immediately or go to your nearest emergency room.")
-        else:
-            await self.session.say("Based on your symptoms, I recommend scheduling an appointment with your healthcare provider soon.")
+        with userdata.latency.time(self.agent_name, "say:emergency_escalation"):
+            if urgency_level.lower() in ["high", "emergency", "urgent"]:
+                await self._say_static(STATIC_UTTERANCES["emergency"])
+            else:
+                await self._say_static(STATIC_UTTERANCES["non_emergency"])
 
 class SupportAgent(BaseMedicalAgent):
     """Patient support agent for appointments and general inquiries"""
@@ -471,21 +568,24 @@ class SupportAgent(BaseMedicalAgent):
         userdata = context.userdata
         session = userdata.patient_session
         
-        session.appointment_type = appointment_type
-        session.add_note(f"Appointment requested: {appointment_type} on {preferred_date} at {preferred_time}", "support")
+        with userdata.latency.time(self.agent_name, "tool:schedule_appointment"):
+            session.appointment_type = appointment_type
+            session.add_note(f"Appointment requested: {appointment_type} on {preferred_date} at {preferred_time}", "support")
         
-        await self.session.say(f"I've noted your request for a {appointment_type} appointment on {preferred_date} at {preferred_time}. Our scheduling team will contact you to confirm.")
+        with userdata.latency.time(self.agent_name, "say:schedule_appointment"):
+            await self.session.say(f"I've noted your request for a {appointment_type} appointment on {preferred_date} at {preferred_time}.")
+            await self._say_static(STATIC_UTTERANCES["appointment_ack"])
 
     @function_tool
     async def transfer_to_billing(self, context: RunContext_T) -> Agent:
         """Transfer to billing for insurance questions"""
-        message = "Let me connect you with our Billing team for insurance and payment assistance."
+        message = STATIC_UTTERANCES["support_to_billing"]
         return await self._transfer_to_agent("billing", context, message)
 
     @function_tool  
     async def transfer_to_triage(self, context: RunContext_T) -> Agent:
         """Transfer back to triage if medical assessment needed"""
-        message = "Let me connect you back with our Triage team for medical assessment."
+        message = STATIC_UTTERANCES["support_to_triage"]
         return await self._transfer_to_agent("triage", context, message)
 
 class BillingAgent(BaseMedicalAgent):
@@ -519,10 +619,12 @@ class BillingAgent(BaseMedicalAgent):
         userdata = context.userdata
         session = userdata.patient_session
         
-        session.insurance_info = f"Provider: {insurance_provider}, Member ID: {member_id}, Group: {group_number}"
-        session.add_note(f"Insurance information collected: {session.insurance_info}", "billing")
+        with userdata.latency.time(self.agent_name, "tool:collect_insurance_info"):
+            session.insurance_info = f"Provider: {insurance_provider}, Member ID: {member_id}, Group: {group_number}"
+            session.add_note(f"Insurance information collected: {session.insurance_info}", "billing")
         
-        await self.session.say("Thank you. I've recorded your insurance information and will verify your coverage.")
+        with userdata.latency.time(self.agent_name, "say:collect_insurance_info"):
+            await self._say_static(STATIC_UTTERANCES["insurance_ack"])
 
     @function_tool
     async def add_billing_question(self, question: str, context: RunContext_T):
@@ -530,23 +632,47 @@ class BillingAgent(BaseMedicalAgent):
         userdata = context.userdata
         session = userdata.patient_session
         
-        session.billing_questions.append(question)
-        session.add_note(f"Billing question: {question}", "billing")
+        with userdata.latency.time(self.agent_name, "tool:add_billing_question"):
+            session.billing_questions.append(question)
+            session.add_note(f"Billing question: {question}", "billing")
         
-        await self.session.say("I've noted your question. Our billing team will follow up with detailed information.")
+        with userdata.latency.time(self.agent_name, "say:add_billing_question"):
+            await self._say_static(STATIC_UTTERANCES["billing_question_ack"])
 
     @function_tool
     async def transfer_to_support(self, context: RunContext_T) -> Agent:
         """Transfer to support for appointment scheduling"""
-        message = "Let me connect you with Patient Support to help with scheduling."
+        message = STATIC_UTTERANCES["billing_to_support"]
         return await self._transfer_to_agent("support", context, message)
 
     @function_tool
     async def transfer_to_triage(self, context: RunContext_T) -> Agent:
         """Transfer to triage for medical questions"""
-        message = "Let me connect you with our Triage team for medical concerns."
+        message = STATIC_UTTERANCES["billing_to_triage"]
         return await self._transfer_to_agent("triage", context, message)
 
+def prewarm(proc: JobProcess):
+    """Load the static utterance audio cache once per worker process, rendering any missing lines"""
+    cache = TTSAudioCache(os.getenv("TTS_CACHE_DIR", "tts_cache"))
+    voice = get_tts_voice_key()
+    missing = cache.load(voice, STATIC_UTTERANCES.values())
+
+    if missing:
+        async def _render_missing():
+            import aiohttp
+            # No job context exists yet, so the TTS needs its own HTTP session
+            async with aiohttp.ClientSession() as http_session:
+                await cache.prewarm(get_tts_instance(http_session=http_session), voice, missing)
+
+        try:
+            asyncio.run(_render_missing())
+        except Exception as e:
+            logger.warning(f"TTS cache prewarm failed, falling back to live TTS: {e}")
+
+    proc.userdata["tts_cache"] = cache
+    # One recorder per worker process so histograms accumulate across calls
+    proc.userdata["latency"] = LatencyRecorder()
+
 async def entrypoint(ctx: JobContext):
     """Main entry point for the medical agent system"""
     await ctx.connect()
@@ -561,7 +687,14 @@ async def entrypoint(ctx: JobContext):
     billing_agent = BillingAgent()
 
     # Create shared user data
-    userdata = MedicalAgentData(ctx=ctx)
+    userdata = MedicalAgentData(ctx=ctx, tts_cache=ctx.proc.userdata.get("tts_cache"))
+    if ctx.proc.userdata.get("latency") is not None:
+        userdata.latency = ctx.proc.userdata["latency"]
+
+    # Build the draft EHR incrementally as notes arrive
+    draft_llm = get_llm_instance(Priority.BACKGROUND) if os.getenv("DRAFT_EHR_LLM", "true").lower() == "true" else None
+    userdata.patient_session.draft_extractor = DraftEHRExtractor(userdata.patient_session, llm=draft_llm)
+    userdata.patient_session.draft_extractor.start()
     userdata.agents.update({
         "triage": triage_agent,
         "support": support_agent,
@@ -571,6 +704,26 @@ async def entrypoint(ctx: JobContext):
     # Temporarily disable MCP connection until Coral is working properly
     session = AgentSession[MedicalAgentData](userdata=userdata)
 
+    @session.on("metrics_collected")
+    def _on_metrics_collected(ev: MetricsCollectedEvent):
+        userdata.latency.on_pipeline_metrics(userdata.patient_session.current_agent, ev.metrics)
+
+    # session.start() returns once the session is set up, so end-of-call work runs at job shutdown
+    async def _on_shutdown():
+        logger.info("Session ending - performing final save...")
+        userdata.latency.flush()
+        logger.info(f"Latency summary: {userdata.latency.summary()}")
+        await userdata.patient_session.draft_extractor.drain()
+        if not userdata.patient_session.conversation_ended:
+            filename = userdata.patient_session.auto_save_notes()
+            if filename:
+                logger.info(f"Final session notes saved to {filename}")
+        await userdata.patient_session.draft_extractor.aclose()
+        # The agents' LLM clients share this job's connection pools
+        await get_gateway().aclose_async_clients()
+
+    ctx.add_shutdown_callback(_on_shutdown)
+
     logger.info("Starting session with Triage Agent...")
     
     try:
@@ -580,13 +733,6 @@ async def entrypoint(ctx: JobContext):
         )
     except Exception as e:
         logger.error(f"Session error: {e}")
-    finally:
-        # Ensure notes are saved when session ends
-        logger.info("Session ending - performing final save...")
-        if not userdata.patient_session.conversation_ended:
-            filename = userdata.patient_session.auto_save_notes()
-            if filename:
-                logger.info(f"Final session notes saved to {filename}")
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint))
\ No newline at end of file
+    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
\ No newline at end of file
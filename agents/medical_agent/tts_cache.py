@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of pre-rendered TTS audio for the fixed utterances the
+voice agents speak on every call (transfer messages, acknowledgements,
+closing line). Entries are keyed by (voice, text) and stored as 16-bit
+PCM WAV files so they can be played back through ``session.say(audio=...)``
+without a round trip to the TTS provider.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import wave
+from pathlib import Path
+from typing import AsyncIterable, Dict, Iterable, Optional, Tuple
+
+from livekit import rtc
+
+logger = logging.getLogger("medical-agent.tts-cache")
+
+# Length of each frame handed back to the playout pipeline
+FRAME_DURATION_MS = 100
+
+
+def cache_key(voice: str, text: str) -> str:
+    """Stable file-safe key for a (voice, text) pair"""
+    return hashlib.sha256(f"{voice}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class TTSAudioCache:
+    """Pre-rendered audio for static utterances, persisted under ``cache_dir``"""
+
+    def __init__(self, cache_dir: str = "tts_cache"):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # key -> (pcm bytes, sample_rate, num_channels)
+        self._entries: Dict[str, Tuple[bytes, int, int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.wav"
+
+    def _read(self, key: str) -> Optional[Tuple[bytes, int, int]]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            with wave.open(str(path), "rb") as wav:
+                pcm = wav.readframes(wav.getnframes())
+                entry = (pcm, wav.getframerate(), wav.getnchannels())
+        except (wave.Error, EOFError, OSError) as e:
+            logger.warning(f"Discarding unreadable TTS cache entry {path}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def _write(self, key: str, pcm: bytes, sample_rate: int, num_channels: int):
+        path = self._path(key)
+        tmp_path = path.with_suffix(".wav.tmp")
+        with wave.open(str(tmp_path), "wb") as wav:
+            wav.setnchannels(num_channels)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(pcm)
+        os.replace(tmp_path, path)
+        self._entries[key] = (pcm, sample_rate, num_channels)
+
+    def contains(self, voice: str, text: str) -> bool:
+        key = cache_key(voice, text)
+        return key in self._entries or self._read(key) is not None
+
+    def load(self, voice: str, texts: Iterable[str]) -> list:
+        """Load cached entries into memory, returning the texts still missing"""
+        return [text for text in texts if not self.contains(voice, text)]
+
+    async def render(self, tts, voice: str, text: str) -> bool:
+        """Synthesize ``text`` with ``tts`` and store the resulting frames"""
+        chunks = []
+        sample_rate = tts.sample_rate
+        num_channels = tts.num_channels
+        try:
+            async with tts.synthesize(text) as stream:
+                async for audio in stream:
+                    frame = audio.frame
+                    sample_rate = frame.sample_rate
+                    num_channels = frame.num_channels
+                    chunks.append(bytes(frame.data))
+        except Exception as e:
+            logger.error(f"Failed to pre-render TTS for '{text[:40]}...': {e}")
+            return False
+
+        if not chunks:
+            return False
+        self._write(cache_key(voice, text), b"".join(chunks), sample_rate, num_channels)
+        return True
+
+    async def prewarm(self, tts, voice: str, texts: Iterable[str]) -> int:
+        """Render every text missing from the cache, returning how many were added"""
+        missing = self.load(voice, texts)
+        if not missing:
+            return 0
+        results = await asyncio.gather(*(self.render(tts, voice, text) for text in missing))
+        rendered = sum(1 for ok in results if ok)
+        logger.info(f"Pre-rendered {rendered}/{len(missing)} static utterances for voice {voice}")
+        return rendered
+
+    def frames(self, voice: str, text: str) -> Optional[AsyncIterable[rtc.AudioFrame]]:
+        """Cached audio for (voice, text) as a frame stream, or None on a miss"""
+        key = cache_key(voice, text)
+        entry = self._entries.get(key) or self._read(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        pcm, sample_rate, num_channels = entry
+        return _iter_frames(pcm, sample_rate, num_channels)
+
+
+async def _iter_frames(pcm: bytes, sample_rate: int, num_channels: int) -> AsyncIterable[rtc.AudioFrame]:
+    samples_per_frame = sample_rate * FRAME_DURATION_MS // 1000
+    bytes_per_frame = samples_per_frame * num_channels * 2
+    for offset in range(0, len(pcm), bytes_per_frame):
+        chunk = pcm[offset:offset + bytes_per_frame]
+        yield rtc.AudioFrame(
+            data=chunk,
+            sample_rate=sample_rate,
+            num_channels=num_channels,
+            samples_per_channel=len(chunk) // (num_channels * 2),
+        )
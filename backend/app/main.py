@@ -26,6 +26,8 @@ app.add_middleware(
 # Import the chatbot class
 import sys
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent / "agents" / "chatbot_agent"))
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent / "agents"))
+from common.sharded_store import EHR_OUTPUT_METADATA, ShardedStore
 
 # Import with a different module name to avoid circular import
 import importlib.util
@@ -66,6 +68,8 @@ def get_chatbot():
 
 # Rest of your code remains the same...
 EHR_OUTPUTS_DIR = Path(__file__).resolve().parent.parent.parent / "agents" / "ehr_agent" / "ehr_outputs"
+# Sharded layout: files are found by name, never by listing the directory
+ehr_store = ShardedStore(EHR_OUTPUTS_DIR, exclude=EHR_OUTPUT_METADATA)
 
 # Pydantic models for request/response
 class ChatMessage(BaseModel):
@@ -78,7 +82,7 @@ class ChatResponse(BaseModel):
 
 @app.get("/api/patient/{patient_id}")
 def get_patient(patient_id: str):
-    yaml_path = EHR_OUTPUTS_DIR / f"{patient_id}.yaml"
+    yaml_path = ehr_store.resolve(f"{patient_id}.yaml")
     if not yaml_path.exists():
         raise HTTPException(status_code=404, detail="Patient not found")
 
@@ -93,13 +97,17 @@ def get_patient(patient_id: str):
 @app.get("/api/patients")
 def get_all_patients():
     patients = []
-    for yaml_file in EHR_OUTPUTS_DIR.glob("*.yaml"):
+    for name in ehr_store.names():
+        yaml_file = ehr_store.resolve(name)
         try:
             with open(yaml_file, "r") as f:
                 data = yaml.safe_load(f)
+            if not isinstance(data, dict):
+                # Name reserved by the EHR agent but not written yet
+                continue
             patient_id = yaml_file.stem
             patients.append({"id": patient_id, **data})
-        except yaml.YAMLError as e:
+        except (OSError, yaml.YAMLError) as e:
             print(f"⚠️ Error parsing {yaml_file.name}: {e}")
             # skip this file
             continue
@@ -107,18 +115,18 @@ def get_all_patients():
     return {"patients": patients}
 
 PATIENT_NOTES_DIR = Path(__file__).resolve().parent.parent.parent / "agents" / "medical_agent" / "patient_notes"
+notes_store = ShardedStore(PATIENT_NOTES_DIR)
 
 @app.get("/api/latest_note")
 def get_latest_note():
     if not PATIENT_NOTES_DIR.exists():
         raise HTTPException(status_code=404, detail="Notes directory not found")
 
-    yaml_files = list(PATIENT_NOTES_DIR.glob("*.yaml"))
-    if not yaml_files:
+    # The most recently written file is the journal entry with the highest recorded mtime
+    latest_name = notes_store.latest()
+    if not latest_name:
         raise HTTPException(status_code=404, detail="No patient notes found")
-
-    # Pick the most recently modified file
-    latest_file = max(yaml_files, key=os.path.getmtime)
+    latest_file = notes_store.resolve(latest_name)
 
     with open(latest_file, "r") as f:
         data = yaml.safe_load(f)
@@ -216,7 +224,8 @@ def get_chatbot_status():
         return {
             "status": "available",
             "patient_count": len(chatbot.patient_data),
-            "model": chatbot.llm_model
+            "model": chatbot.llm_model,
+            "patient_store": chatbot.patient_data.metrics()
         }
     except Exception as e:
         return {"status": "error", "error": str(e), "patient_count": 0}
\ No newline at end of file